@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""Exact DTW k-nearest neighbour search
+
+A drop-in for the LSHBOX indexes (init_mat / query) that returns the exact k
+nearest training series under DTW restricted to a Sakoe-Chiba band. Like the
+UCR suite, candidates go through a cascade of lower bounds before any DTW is
+computed:
+
+ 1. LB_Kim: the first and last points, which every warping path aligns
+ 2. LB_Keogh: the query against the precomputed envelope of the candidate
+ 3. DTW with early abandoning against the current k-th best distance
+
+Candidates are visited in increasing lower bound order, so once a bound
+exceeds the k-th best distance found so far, all remaining ones are pruned.
+Distances are squared point differences, summed along the warping path
+(arraydtw.band_dtw).
+"""
+
+import heapq
+import numpy as np
+from arraydtw import band_dtw
+
+
+def envelope(dat, window):
+    """Upper and lower envelopes: running max / min over [i-window, i+window]."""
+    upper = dat.copy()
+    lower = dat.copy()
+    for s in xrange(1, window+1):
+        np.maximum(upper[:, s:], dat[:, :-s], out=upper[:, s:])
+        np.maximum(upper[:, :-s], dat[:, s:], out=upper[:, :-s])
+        np.minimum(lower[:, s:], dat[:, :-s], out=lower[:, s:])
+        np.minimum(lower[:, :-s], dat[:, s:], out=lower[:, :-s])
+    return upper, lower
+
+
+class DTWSearch(object):
+
+    def __init__(self):
+        self.candidates = 0
+        self.kim_pruned = 0
+        self.keogh_pruned = 0
+        self.dtw_computed = 0
+        self.dtw_abandoned = 0
+
+    def init_mat(self, dat, window):
+        self.dat = np.asarray(dat, dtype=np.float64)
+        if self.dat.ndim != 2:
+            raise ValueError('DTW search needs time series of equal length')
+        self.window = window
+        self.rows = self.dat.tolist()
+        self.upper, self.lower = envelope(self.dat, window)
+
+    def query(self, vec, type, k):
+        ## type is only there for compatibility with the LSHBOX indexes
+        q = np.asarray(vec, dtype=np.float64)
+        if len(q) != self.dat.shape[1]:
+            raise ValueError('Query length %d differs from the database (%d)' %(len(q), self.dat.shape[1]))
+        lb_kim = (q[0] - self.dat[:, 0])**2 + (q[-1] - self.dat[:, -1])**2
+        above = np.maximum(q - self.upper, 0)
+        below = np.maximum(self.lower - q, 0)
+        lb_keogh = (above*above + below*below).sum(axis=1)
+        lb = np.maximum(lb_kim, lb_keogh)
+        order = np.argsort(lb, kind='mergesort')
+        k = min(k, len(order))
+        self.candidates += len(order)
+
+        q = q.tolist()
+        ## max-heap of the best k as (-distance, -index)
+        heap = []
+        bsf = float('inf')
+        for n, c in enumerate(order.tolist()):
+            if lb[c] > bsf:
+                rest = order[n:]
+                kim = lb_kim[rest] > bsf
+                self.kim_pruned += np.count_nonzero(kim)
+                self.keogh_pruned += len(rest) - np.count_nonzero(kim)
+                break
+            dist = band_dtw(q, self.rows[c], self.window, bsf)
+            self.dtw_computed += 1
+            if dist == float('inf'):
+                self.dtw_abandoned += 1
+                continue
+            if len(heap) < k:
+                heapq.heappush(heap, (-dist, -c))
+            elif (dist, c) < (-heap[0][0], -heap[0][1]):
+                heapq.heapreplace(heap, (-dist, -c))
+            if len(heap) == k:
+                bsf = -heap[0][0]
+        result = sorted((-d, -c) for d, c in heap)
+        return [[c for d, c in result], [d for d, c in result]]
+
+    def stats(self):
+        return ('DTW search: %d candidates, %d pruned by LB_Kim, %d pruned by LB_Keogh, '
+                '%d DTW computed (%d abandoned early)'
+                %(self.candidates, self.kim_pruned, self.keogh_pruned, self.dtw_computed, self.dtw_abandoned))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""On-disk cache of the training-set DTW distance matrix
+
+The matrix is stored condensed (upper triangle without the diagonal, row
+by row) as a float64 .npy file, so later runs can memory-map it. The file
+name carries the filecache key of the training file and the DTW settings,
+so a changed database or different settings never hit an old file.
+"""
+
+import array
+import itertools
+import numpy as np
+from collections import OrderedDict
+import filecache
+
+
+def cache_path(database, key, cache_dir=None, partial=False):
+    ## key: filecache.cache_key of the database and the DTW settings
+    return filecache.cache_path(database, 'dtw', key, cache_dir, '.partial.npy' if partial else '.npy')
+
+def condensed_size(length):
+    return length*(length-1)//2
+
+def condensed_offset(length, i, j):
+    ## position of (i, j), i < j, in the condensed array
+    return i*length - i*(i+1)//2 + j - i - 1
+
+class DistanceMatrix(object):
+    """Symmetric matrix with a zero diagonal, stored as its condensed upper
+    triangle: n(n-1)/2 float64 instead of n*n boxed Python floats."""
+
+    def __init__(self, length, condensed=None):
+        self.length = length
+        if condensed is None:
+            condensed = np.zeros(condensed_size(length))
+        self.condensed = condensed
+
+    def offset(self, i, j):
+        return condensed_offset(self.length, i, j)
+
+    def __getitem__(self, ij):
+        i, j = ij
+        if i == j:
+            return 0.0
+        if i > j:
+            i, j = j, i
+        return float(self.condensed[self.offset(i, j)])
+
+    def set_row(self, i, j_s, values):
+        ## values for (i, j_s), (i, j_s+1), ... which are contiguous in the condensed array
+        start = self.offset(i, j_s)
+        self.condensed[start:start+len(values)] = values
+
+    def submatrix(self, index):
+        """The len(index) x len(index) matrix of the pairwise distances of index."""
+        index = np.asarray(index, dtype=np.intp)
+        lo = np.minimum(index[:, None], index[None, :])
+        hi = np.maximum(index[:, None], index[None, :])
+        same = lo == hi
+        return np.where(same, 0.0, self.condensed[np.where(same, 0, self.offset(lo, hi))])
+
+class LazyDistanceMatrix(object):
+    """Same interface as DistanceMatrix, but a distance is only computed, by
+    pair_dist(i, j), the first time it is asked for.
+
+    Computed distances go to a bounded LRU memo table. If store_path is
+    given, the memo is backed by a partial cache there: the distances of
+    earlier runs are loaded from it (see load_partial) and looked up when
+    they are not in the memo, and flush writes them back along with those
+    computed since.
+    """
+
+    def __init__(self, length, pair_dist, capacity=1000000, store_path=None):
+        self.length = length
+        self.pair_dist = pair_dist
+        self.capacity = capacity
+        self.store_path = store_path
+        self.stored = load_partial(store_path) if store_path is not None else None
+        ## the distances computed since and their offsets (as doubles, exact
+        ## up to 2**53), to add to the store
+        self.added_keys = array.array('d')
+        self.added_values = array.array('d')
+        self.memo = OrderedDict()
+        self.computed = 0
+
+    def offset(self, i, j):
+        return condensed_offset(self.length, i, j)
+
+    def _lookup(self, keys, I, J):
+        values = np.empty(len(keys))
+        memo = self.memo
+        stored = self.stored
+        for m, key in enumerate(keys.tolist()):
+            if key in memo:
+                values[m] = memo[key] = memo.pop(key)
+                continue
+            if stored is not None and key in stored:
+                value = stored[key]
+            else:
+                value = self.pair_dist(I[m], J[m])
+                self.computed += 1
+                if stored is not None:
+                    self.added_keys.append(key)
+                    self.added_values.append(value)
+            values[m] = memo[key] = value
+            if len(memo) > self.capacity:
+                memo.popitem(last=False)
+        return values
+
+    def __getitem__(self, ij):
+        i, j = ij
+        if i == j:
+            return 0.0
+        if i > j:
+            i, j = j, i
+        return float(self._lookup(np.array([self.offset(i, j)]), [i], [j])[0])
+
+    def submatrix(self, index):
+        """The len(index) x len(index) matrix of the pairwise distances of index."""
+        index = np.asarray(index, dtype=np.intp)
+        lo = np.minimum(index[:, None], index[None, :])
+        hi = np.maximum(index[:, None], index[None, :])
+        upper = lo < hi
+        keys, first, inverse = np.unique(self.offset(lo, hi)[upper],
+                                         return_index=True, return_inverse=True)
+        sub = np.zeros(lo.shape)
+        sub[upper] = self._lookup(keys, lo[upper][first], hi[upper][first])[inverse]
+        return sub
+
+    def flush(self):
+        """Write the stored and newly computed distances to the partial
+        cache, if there are new ones."""
+        if self.store_path is None or not len(self.added_keys):
+            return
+        records = np.empty((len(self.stored) + len(self.added_keys), 2))
+        records[:len(self.stored), 0] = self.stored.keys()
+        records[:len(self.stored), 1] = self.stored.values()
+        records[len(self.stored):, 0] = self.added_keys
+        records[len(self.stored):, 1] = self.added_values
+        save_partial(self.store_path, records, self.length)
+        self.stored.update(itertools.izip(itertools.imap(int, self.added_keys), self.added_values))
+        self.added_keys = array.array('d')
+        self.added_values = array.array('d')
+
+def load_partial(path):
+    """The distances of a partial cache, {condensed offset: distance}, empty
+    if there is none or it is unusable.
+
+    A partial cache holds the computed pairs only, as an (m, 2) float64
+    array of (condensed offset, distance) records, so it grows with the
+    pairs the queries needed rather than with the whole matrix.
+    """
+    records = filecache.load(path, (None, 2), 'DTW cache')
+    if records is None:
+        return {}
+    return dict(itertools.izip(records[:, 0].astype(np.int64).tolist(), records[:, 1].tolist()))
+
+def save_partial(path, records, length):
+    """Write the (offset, distance) records of a partial cache atomically."""
+    def check(records):
+        offsets = records[:, 0]
+        if ((offsets < 0) | (offsets >= condensed_size(length)) | (offsets != np.floor(offsets))).any():
+            raise ValueError('invalid offsets')
+        check_distances(records[:, 1])
+    filecache.save(path, records, 'DTW cache', check)
+
+def check_distances(condensed):
+    if not np.isfinite(condensed).all() or (condensed < 0).any():
+        raise ValueError('invalid distances')
+
+def load(path, length):
+    """Memory-map a cached DistanceMatrix, None if it is missing or unusable."""
+    condensed = filecache.load(path, (condensed_size(length),), 'DTW cache')
+    if condensed is None:
+        return None
+    return DistanceMatrix(length, condensed)
+
+def save(path, matrix):
+    """Write the condensed matrix atomically (write + rename), if all its
+    distances are valid."""
+    filecache.save(path, matrix.condensed, 'DTW cache', check_distances)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""Exact Euclidean k-nearest neighbour search
+
+Drop-ins for the LSHBOX indexes (init_mat / query) that return the exact k
+nearest training series.
+
+EuclideanSearch suits many queries at once (query_batch): the squared
+norms of the training series are computed once; the distances of a block
+of queries to all of them then take one matrix product, |a|^2 + |b|^2 -
+2ab, and the k smallest are picked with a partial selection instead of a
+full sort. The expansion loses a little precision against summing (a-b)^2
+directly, so the candidates within rounding error of the k-th distance are
+scored again exactly, with the point differences summed in order as
+Python's sum does. The neighbours are those of a full stable sort of the
+exact distances: nearest first, ties to the lower index.
+
+EarlyAbandonSearch suits queries one at a time, as in the UCR suite: the
+series are z-normalized once, the k candidates with the smallest PAA lower
+bound seed the k-th best distance, every candidate whose bound exceeds it
+is dropped, and the distances of the others are summed over the points in
+order of decreasing query magnitude (the largest terms first), a chunk at
+a time, abandoning each candidate once its partial sum passes the k-th
+best.
+"""
+
+import numpy as np
+
+## distances computed at a time, bounding the memory of a query block
+BLOCK_DISTANCES = 1 << 22
+## relative rounding error allowed on |a|^2 + |b|^2 - 2ab
+RESCORE_TOL = 1e-9
+## PAA segments of the lower bound, and points summed between two
+## early abandoning checks
+PAA_SEGMENTS = 16
+ABANDON_CHUNK = 16
+## relative rounding error allowed on the PAA lower bound
+LB_TOL = 1e-9
+
+
+def znormalize(dat):
+    ## zero mean and unit variance along the last axis; constant series
+    ## are only centred
+    dat = np.asarray(dat, dtype=np.float64)
+    std = dat.std(axis=-1)
+    std = np.where(std > 0, std, 1.0)
+    return (dat - dat.mean(axis=-1)[..., None])/std[..., None]
+
+def squared_distances(q, rows):
+    ## exact, summed left to right like sum([(x-y)**2 ...])
+    return np.cumsum((rows - q)**2, axis=1)[:, -1]
+
+
+class EuclideanSearch(object):
+
+    def __init__(self):
+        self.queries = 0
+        self.rescored = 0
+
+    def init_mat(self, dat):
+        self.dat = np.asarray(dat, dtype=np.float64)
+        if self.dat.ndim != 2:
+            raise ValueError('Euclidean search needs time series of equal length')
+        self.norms = np.einsum('ij,ij->i', self.dat, self.dat)
+        self.max_norm = self.norms.max() if len(self.norms) else 0.0
+
+    def query(self, vec, type, k):
+        ## type is only there for compatibility with the LSHBOX indexes
+        index, dists = self.query_block(np.asarray(vec, dtype=np.float64)[None, :], k)
+        return [index[0], dists[0]]
+
+    def query_batch(self, queries, k):
+        """The neighbours of every query, as [query(q, 2, k)[0] for q in queries]."""
+        queries = np.asarray(queries, dtype=np.float64)
+        block = max(1, BLOCK_DISTANCES // max(len(self.dat), 1))
+        result = []
+        for s in xrange(0, len(queries), block):
+            result.extend(self.query_block(queries[s:s+block], k)[0])
+        return result
+
+    def query_block(self, queries, k):
+        if queries.ndim != 2 or queries.shape[1] != self.dat.shape[1]:
+            raise ValueError('Query length %d differs from the database (%d)' %(queries.shape[-1], self.dat.shape[1]))
+        n = len(self.dat)
+        k = min(k, n)
+        q_norms = np.einsum('ij,ij->i', queries, queries)
+        approx = np.dot(queries, self.dat.T)
+        approx *= -2
+        approx += q_norms[:, None]
+        approx += self.norms[None, :]
+        if k < n:
+            kth = np.partition(approx, k-1, axis=1)[:, k-1]
+        else:
+            kth = approx.max(axis=1)
+        ## everything that may be within the k nearest, given the rounding
+        margin = 2*RESCORE_TOL*(q_norms + self.max_norm)
+        index, dists = [], []
+        for q, row, bound in zip(queries, approx, kth + margin):
+            candidates = np.flatnonzero(row <= bound)
+            exact = squared_distances(q, self.dat[candidates])
+            order = np.lexsort((candidates, exact))[:k]
+            index.append(candidates[order].tolist())
+            dists.append(exact[order].tolist())
+            self.rescored += len(candidates)
+        self.queries += len(queries)
+        return index, dists
+
+    def stats(self):
+        return ('Euclidean search: %d queries, %.1f candidates scored exactly per query'
+                %(self.queries, self.rescored*1.0/max(self.queries, 1)))
+
+
+class EarlyAbandonSearch(object):
+
+    def __init__(self, segments=PAA_SEGMENTS, chunk=ABANDON_CHUNK):
+        self.segments = segments
+        self.chunk = chunk
+        self.candidates = 0
+        self.lb_pruned = 0
+        self.abandoned = 0
+        self.points = 0
+
+    def init_mat(self, dat, znorm=True):
+        self.znorm = znorm
+        dat = np.asarray(dat, dtype=np.float64)
+        if dat.ndim != 2:
+            raise ValueError('Euclidean search needs time series of equal length')
+        if znorm:
+            dat = znormalize(dat)
+        ## one row per point, so that the points of a chunk are contiguous
+        self.points_by_row = np.ascontiguousarray(dat.T)
+        length = dat.shape[1]
+        self.starts = np.unique(np.linspace(0, length, min(self.segments, length), endpoint=False).astype(np.intp))
+        self.lengths = np.diff(np.append(self.starts, length))
+        self.paa = np.add.reduceat(dat, self.starts, axis=1)/self.lengths
+
+    def distances(self, q, order, rows, bsf=np.inf):
+        """Squared distances of q to the training rows listed in rows, the
+        points summed in order, a chunk at a time; rows whose partial sum
+        passes bsf are dropped. Returns (rows left, their distances)."""
+        partial = np.zeros(len(rows))
+        for s in xrange(0, len(order), self.chunk):
+            if not len(rows):
+                break
+            cols = order[s:s+self.chunk]
+            diff = self.points_by_row[np.ix_(cols, rows)] - q[cols][:, None]
+            partial += (diff*diff).sum(axis=0)
+            self.points += len(cols)*len(rows)
+            keep = partial <= bsf
+            if not keep.all():
+                rows, partial = rows[keep], partial[keep]
+        return rows, partial
+
+    def query(self, vec, type, k):
+        ## type is only there for compatibility with the LSHBOX indexes
+        q = np.asarray(vec, dtype=np.float64)
+        if len(q) != self.points_by_row.shape[0]:
+            raise ValueError('Query length %d differs from the database (%d)' %(len(q), self.points_by_row.shape[0]))
+        if self.znorm:
+            q = znormalize(q)
+        n = self.points_by_row.shape[1]
+        k = min(k, n)
+        self.candidates += n
+
+        ## PAA lower bound: a segment of L points is at least L times the
+        ## squared difference of its means away
+        q_paa = np.add.reduceat(q, self.starts)/self.lengths
+        lb = ((self.paa - q_paa)**2*self.lengths).sum(axis=1)
+        order = np.argsort(-np.abs(q), kind='mergesort')
+
+        ## the k candidates of smallest bound seed the k-th best distance
+        seeds = np.sort(np.argpartition(lb, k-1)[:k]) if k < n else np.arange(n)
+        seeds, seed_dists = self.distances(q, order, seeds)
+        bsf = seed_dists.max()
+        rest = lb <= bsf*(1 + LB_TOL)
+        rest[seeds] = False
+        rows = np.flatnonzero(rest)
+        self.lb_pruned += n - len(seeds) - len(rows)
+        left, dists = self.distances(q, order, rows, bsf)
+        self.abandoned += len(rows) - len(left)
+
+        candidates = np.concatenate((seeds, left))
+        dists = np.concatenate((seed_dists, dists))
+        top = np.lexsort((candidates, dists))[:k]
+        return [candidates[top].tolist(), dists[top].tolist()]
+
+    def stats(self):
+        return ('Euclidean search: %d candidates, %d pruned by the PAA bound, %d abandoned early, '
+                '%.2f%% of the point differences of a brute force search'
+                %(self.candidates, self.lb_pruned, self.abandoned,
+                  self.points*100.0/max(self.candidates*self.points_by_row.shape[0], 1)))
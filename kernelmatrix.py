@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""Training-set kernel matrix for libsvm's precomputed kernel (-t 4)
+
+Every per-query SVM of CLAMP is trained on a subset of the same training
+set, so the kernel values between training series are computed once, with
+a few matrix products, instead of by libsvm for every query. A per-query
+problem is then the k x k block of the neighbours, with the serial number
+column libsvm expects, and the query is passed as its kernel values with
+the neighbours.
+"""
+
+import numpy as np
+from svmpy import svmutil as svm
+
+
+def kernel(x, y, kernel_type, degree, gamma, coef0):
+    """The kernel of the rows of x with the rows of y, as in libsvm."""
+    dot = np.dot(x, y.T)
+    if kernel_type == svm.LINEAR:
+        return dot
+    if kernel_type == svm.POLY:
+        return (gamma*dot + coef0)**degree
+    if kernel_type == svm.RBF:
+        sq = (x*x).sum(axis=1)[:, None] + (y*y).sum(axis=1)[None, :] - 2*dot
+        return np.exp(-gamma*np.maximum(sq, 0))
+    if kernel_type == svm.SIGMOID:
+        return np.tanh(gamma*dot + coef0)
+    raise ValueError('Kernel type %d cannot be precomputed' %(kernel_type))
+
+
+class KernelMatrix(object):
+    """Kernel values between all the rows of dat, for the kernel and its
+    parameters in param (an svm_parameter); gamma 0 means 1/number of
+    features, the libsvm default."""
+
+    def __init__(self, dat, param):
+        self.dat = np.asarray(dat, dtype=np.float64)
+        self.kernel_type = param.kernel_type
+        self.degree = param.degree
+        self.gamma = param.gamma if param.gamma else 1.0/self.dat.shape[1]
+        self.coef0 = param.coef0
+        self.gram = self.kernel(self.dat)
+
+    def kernel(self, x, rows=None):
+        y = self.dat if rows is None else self.dat[rows]
+        return kernel(x, y, self.kernel_type, self.degree, self.gamma, self.coef0)
+
+    def problem(self, y, rows):
+        """The precomputed-kernel problem of labels y and the rows listed
+        in rows: row i is its serial number i+1, then its kernel values."""
+        rows = np.asarray(rows, dtype=np.intp)
+        x = np.empty((len(rows), len(rows) + 1))
+        x[:, 0] = np.arange(1, len(rows) + 1)
+        x[:, 1:] = self.gram[np.ix_(rows, rows)]
+        return svm.svm_problem.from_dense(y, x, isKernel=True)
+
+    def query_row(self, vec, rows):
+        """vec as libsvm expects it for a model trained on problem(y, rows)."""
+        values = self.kernel(np.asarray(vec, dtype=np.float64)[None, :], rows)[0]
+        return [0.0] + values.tolist()
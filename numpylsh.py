@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""LSHBOX's psdLsh and rhpLsh in numpy
+
+Stand-ins for the compiled LSHBOX module (libpylshbox, pylshbox on
+Windows) with the same init_mat / query(vec, type, k) interface and
+parameters, used when that module is not installed.
+
+psdlsh is p-stable LSH (E2LSH): table l hashes x to
+floor((a_l.x + b_l)/W) mod M, a_l drawn from the Cauchy (T = 1, L1) or the
+Gaussian (T = 2, L2) distribution and b_l uniform in [0, W). rhplsh is
+random hyperplane LSH: table l combines the signs of N random hyperplanes
+into a bucket out of M. All training series are hashed into all L tables
+with one matrix product. Each table is stored as the training rows sorted
+by bucket, with the sorted bucket numbers to find a bucket's rows by
+binary search, instead of a list per bucket. A query collects the rows
+sharing a bucket with it in any table and ranks them by their exact
+distance, so like LSHBOX it returns fewer than k neighbours when fewer
+candidates are found.
+
+As LSHBOX does, init_mat loads the index from its file argument when that
+exists, and builds the index and saves it there otherwise.
+
+With probes > 0 a query is multi-probe (Lv et al., 2007): besides its own
+bucket, it also looks in the probes buckets of each table that it most
+nearly fell into. For psdlsh these are the neighbouring buckets, scored
+by the distance from the query's projection to them; for rhplsh the
+buckets of its code with some bits flipped, scored by the sum of the
+squared projections on the flipped hyperplanes. Probing finds the
+candidates of more tables in fewer of them, trading query time for the
+memory and index time of the tables.
+"""
+
+import os
+import heapq
+import numpy as np
+
+## psdlsh and rhplsh take probes
+MULTI_PROBE = True
+
+## query(vec, type, k): distance of the final ranking
+L1_DIST = 1
+L2_DIST = 2
+COS_DIST = 3
+
+
+class BucketTables(object):
+    """L hash tables of n rows: table l maps bucket b to the rows whose
+    bucket in it is b."""
+
+    def __init__(self, rows, buckets):
+        ## (L, n) rows of each table in bucket order, and their buckets
+        self.rows = rows
+        self.buckets = buckets
+
+    @classmethod
+    def build(cls, buckets):
+        ## buckets: (n, L) bucket of every row in every table
+        order = np.argsort(buckets, axis=0, kind='mergesort')
+        return cls(np.ascontiguousarray(order.T, dtype=np.int32),
+                   np.ascontiguousarray(buckets[order, np.arange(buckets.shape[1])].T))
+
+    def lookup(self, query_buckets):
+        """The rows in one of the buckets query_buckets[l] of some table l."""
+        found = []
+        for l, b in enumerate(query_buckets):
+            keys = self.buckets[l]
+            for s, e in zip(np.searchsorted(keys, b, 'left'), np.searchsorted(keys, b, 'right')):
+                found.append(self.rows[l, s:e])
+        return np.unique(np.concatenate(found))
+
+
+class _LSH(object):
+
+    def __init__(self, seed=0, probes=0):
+        self.seed = seed
+        self.probes = probes
+        self.candidates = 0
+        self.queries = 0
+
+    def _index(self, dat, file, parms):
+        ## parms: the init_mat parameters, saved with the index
+        self.dat = np.asarray(dat, dtype=np.float64)
+        if self.dat.ndim != 2:
+            raise ValueError('LSH needs time series of equal length')
+        if file and os.path.exists(file):
+            self.load(file, parms)
+            return
+        self.draw(self.dat.shape[1], np.random.RandomState(self.seed))
+        self.tables = BucketTables.build(self.hash(self.dat))
+        if file:
+            self.save(file, parms)
+
+    def save(self, file, parms):
+        arrays = dict((name, getattr(self, name)) for name in self.random_arrays)
+        with open(file, 'wb') as f:
+            np.savez(f, parms=np.array(parms, dtype=np.float64), rows=self.tables.rows,
+                     buckets=self.tables.buckets, **arrays)
+
+    def load(self, file, parms):
+        with np.load(file) as saved:
+            if saved['parms'].tolist() != list(parms) or saved['rows'].shape[1] != len(self.dat):
+                raise ValueError('%s holds an index with other parameters' %(file))
+            for name in self.random_arrays:
+                setattr(self, name, saved[name])
+            self.tables = BucketTables(saved['rows'], saved['buckets'])
+
+    def query(self, vec, type, k):
+        q = np.asarray(vec, dtype=np.float64)
+        candidates = self.tables.lookup(self.probe(q))
+        self.queries += 1
+        self.candidates += len(candidates)
+        rows = self.dat[candidates]
+        if type == L1_DIST:
+            dists = np.abs(rows - q).sum(axis=1)
+        elif type == COS_DIST:
+            norms = np.sqrt((rows*rows).sum(axis=1)*np.dot(q, q))
+            dists = 1 - np.dot(rows, q)/np.where(norms > 0, norms, 1)
+        else:
+            dists = np.sqrt(((rows - q)**2).sum(axis=1))
+        top = np.lexsort((candidates, dists))[:k]
+        return [candidates[top].tolist(), dists[top].tolist()]
+
+    def stats(self):
+        return ('LSH: %d queries, %.1f candidates per query'
+                %(self.queries, self.candidates*1.0/max(self.queries, 1)))
+
+
+class psdlsh(_LSH):
+
+    random_arrays = ('projections', 'offsets')
+
+    def init_mat(self, dat, file, M, L, T, W):
+        if T not in (1, 2):
+            raise ValueError('T must be 1 (L1) or 2 (L2)')
+        self.M, self.L, self.T, self.W = M, L, T, W
+        self._index(dat, file, (M, L, T, W))
+
+    def draw(self, dim, rs):
+        if self.T == 1:
+            self.projections = rs.standard_cauchy((dim, self.L))
+        else:
+            self.projections = rs.standard_normal((dim, self.L))
+        self.offsets = rs.uniform(0, self.W, self.L)
+
+    def hash(self, x):
+        ## (rows, L) buckets
+        return (np.floor((np.dot(x, self.projections) + self.offsets)/self.W) % self.M).astype(np.int64)
+
+    def probe(self, q):
+        ## (L, 1 + probes) buckets of q: its own, then the nearest others
+        position = (np.dot(q, self.projections) + self.offsets)/self.W
+        home = np.floor(position)
+        if not self.probes:
+            return (home % self.M).astype(np.int64)[:, None]
+        ## distance (in W) to the bucket shift away, for the shifts
+        ## -probes..-1, 1..probes
+        f = (position - home)[:, None]
+        shifts = np.concatenate((np.arange(-self.probes, 0), np.arange(1, self.probes + 1)))
+        score = np.where(shifts < 0, -shifts - 1 + f, shifts - f)
+        nearest = shifts[np.argsort(score, axis=1, kind='mergesort')[:, :self.probes]]
+        buckets = np.concatenate((home[:, None], home[:, None] + nearest), axis=1)
+        return (buckets % self.M).astype(np.int64)
+
+
+class rhplsh(_LSH):
+
+    random_arrays = ('planes', 'weights')
+
+    def init_mat(self, dat, file, M, L, N):
+        self.M, self.L, self.N = M, L, N
+        self._index(dat, file, (M, L, N))
+
+    def draw(self, dim, rs):
+        self.planes = rs.standard_normal((dim, self.L*self.N))
+        ## the random weight of each hyperplane in the bucket number
+        self.weights = rs.randint(0, self.M, (self.L, self.N)).astype(np.int64)
+
+    def hash(self, x):
+        signs = (np.dot(x, self.planes) > 0).reshape(len(x), self.L, self.N)
+        return (signs*self.weights).sum(axis=2) % self.M
+
+    def probe(self, q):
+        ## (L, 1 + probes) buckets of q: its own, then the codes with the
+        ## flips of least score
+        margins = np.dot(q, self.planes).reshape(self.L, self.N)
+        signs = margins > 0
+        code = (signs*self.weights).sum(axis=1)
+        if not self.probes:
+            return (code % self.M)[:, None]
+        ## flipping bit i changes the code by step[i]
+        step = np.where(signs, -self.weights, self.weights)
+        buckets = np.empty((self.L, 1 + self.probes), dtype=np.int64)
+        for l in xrange(self.L):
+            order = np.argsort(np.abs(margins[l]), kind='mergesort')
+            flips = flip_sets(margins[l][order]**2, self.probes)
+            shifted = [code[l] + step[l][order[list(f)]].sum() for f in flips]
+            ## fewer flip sets than probes when N is small: probe home again
+            shifted += [code[l]]*(self.probes - len(shifted))
+            buckets[l] = [code[l]] + shifted
+        return buckets % self.M
+
+
+def flip_sets(scores, count):
+    """The count sets of positions with the least total score, in order;
+    scores sorted ascending. The shift / expand generation of multi-probe
+    LSH: every set comes after the one it is derived from."""
+    n = len(scores)
+    result = []
+    heap = [(scores[0], (0,))] if n else []
+    while heap and len(result) < count:
+        score, flips = heapq.heappop(heap)
+        result.append(flips)
+        last = flips[-1]
+        if last + 1 < n:
+            ## shift the last position on, or add the next one
+            heapq.heappush(heap, (score - scores[last] + scores[last + 1], flips[:-1] + (last + 1,)))
+            heapq.heappush(heap, (score + scores[last + 1], flips + (last + 1,)))
+    return result
@@ -9,17 +9,10 @@ import sys
 import argparse
 from datetime import datetime
 from time import time
+import ucrdata
+import euclideanknn
 from svmpy import svmutil as svm
 
-def argsort(seq):
-    return sorted(range(len(seq)), key=seq.__getitem__)
-
-def ec_query(test_dat, train_dat, k):
-    dist = []
-    for train in train_dat:
-        dist.append(sum([ (x-y)**2 for x,y in zip(train, test_dat) ]))
-    return argsort(dist)[0:k]
-
 def main(arguments):
     elapsed_time_s = time()
     parser = argparse.ArgumentParser(description=__doc__)
@@ -46,14 +39,9 @@ def main(arguments):
     
     ## read input file (convert it to a list)
     args = parser.parse_args(arguments)
-    train_class_label = []
-    train_dat = []
-    
-    with open(args.database, 'rU') as f:
-        for l in f:
-            line = l.strip().split(',')
-            train_class_label.append(int(line[0]))
-            train_dat.append(map(float,line[1:]))
+    train_class_label, train_mat = ucrdata.load(args.database)
+    train_class_label = train_class_label.tolist()
+    train_dat = train_mat.tolist()
     if args.k == -1:
         k = min( int(0.2*len(train_class_label)), 100 )
     else:
@@ -66,21 +54,27 @@ def main(arguments):
     sys.stderr.write('Number of Nearest Neighbours (K): %d \n' %(k))
 
 
+    ## exact search: training norms once, queries in blocks
+    search = euclideanknn.EuclideanSearch()
+    search.init_mat(train_mat)
+
     accuracy  = 0
     with open(args.query, 'rU') as f:
-        counter = 0
-        correct_prediction = 0
+        queries = []
         for l in f:
-            counter += 1
             line = l.strip().split(',')
             if args.isTesting:
-                test_class_label = int(line[0])
-                test_dat = map(float, line[1:])
+                queries.append((int(line[0]), map(float, line[1:])))
             else:
-                test_dat = map(float, line)
-                
-            result = ec_query(test_dat, train_dat, k)
-            kNN_index = result
+                queries.append((1, map(float, line)))
+        knn_time_s = time()
+        kNN_indexes = search.query_batch([test_dat for test_class_label, test_dat in queries], k)
+        knn_time = time() - knn_time_s
+
+        counter = 0
+        correct_prediction = 0
+        for (test_class_label, test_dat), kNN_index in zip(queries, kNN_indexes):
+            counter += 1
 
             kNN_labels = [ train_class_label[i] for i in kNN_index]
 
@@ -110,6 +104,7 @@ def main(arguments):
                 correct_prediction += 1
 
         sys.stderr.write('=============================================================\n')
+        sys.stderr.write(search.stats() + ' \n')
         sys.stderr.write("Number of test cases: %d \n" %(counter))    
         sys.stderr.write("Number of correct predictions: %d \n" %(correct_prediction))
         accuracy = correct_prediction*1.0/counter
@@ -120,6 +115,7 @@ def main(arguments):
     
     args.outfile.write('Accuracy\t%f\n' %(accuracy))
     args.outfile.write('Elapsed_Time\t%s\n' %(elapsed_time))
+    args.outfile.write('kNNTime\t%s\n' %(knn_time))
     args.outfile.write('TrainingTime\t%s\n' %(total_train_time))
     args.outfile.write('TestingTime\t%s\n' %(total_test_time))    
     
@@ -9,6 +9,7 @@ import sys
 import argparse
 from datetime import datetime
 from time import time
+import ucrdata
 from svmpy import svmutil as svm
 
 def argsort(seq):
@@ -41,14 +42,9 @@ def main(arguments):
     
     ## read input file (convert it to a list)
     args = parser.parse_args(arguments)
-    train_class_label = []
-    train_dat = []
-    
-    with open(args.database, 'rU') as f:
-        for l in f:
-            line = l.strip().split(',')
-            train_class_label.append(int(line[0]))
-            train_dat.append(map(float,line[1:]))
+    train_class_label, train_dat = ucrdata.load(args.database)
+    train_class_label = train_class_label.tolist()
+    train_dat = train_dat.tolist()
     
     total_train_time = 0
     total_test_time = 0
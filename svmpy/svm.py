@@ -5,11 +5,16 @@ from ctypes.util import find_library
 from os import path
 import sys
 
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
 __all__ = ['libsvm', 'svm_problem', 'svm_parameter',
            'toPyModel', 'gen_svm_nodearray', 'print_null', 'svm_node', 'C_SVC',
            'EPSILON_SVR', 'LINEAR', 'NU_SVC', 'NU_SVR', 'ONE_CLASS',
            'POLY', 'PRECOMPUTED', 'PRINT_STRING_FUN', 'RBF',
-           'SIGMOID', 'c_double', 'svm_model']
+           'SIGMOID', 'c_double', 'svm_model', 'svm_node_pool']
 
 try:
 	dirname = path.dirname(path.abspath(__file__))
@@ -108,6 +113,107 @@ class svm_problem(Structure):
 		self.x = (POINTER(svm_node) * l)()
 		for i, xi in enumerate(self.x_space): self.x[i] = xi
 
+	@classmethod
+	def from_dense(cls, y, x, isKernel=None):
+		"""
+		svm_problem.from_dense(y, x [, isKernel]) -> svm_problem
+
+		Same problem as svm_problem(y, x, isKernel) for a dense 2-D array
+		x, built with a few numpy operations instead of row by row: the
+		nodes of all rows live in one contiguous block, x points into it.
+		"""
+		return svm_node_pool(x, isKernel).problem(y, range(len(x)))
+
+## svm_node as a numpy structured type, with the same layout
+if np is not None:
+	svm_node_dtype = np.dtype([('index', np.intc), ('value', np.float64)], align=True)
+	assert svm_node_dtype.itemsize == sizeof(svm_node)
+
+class svm_node_rows(object):
+	"""
+	Rows of svm_node, terminated by index -1, stored in one numpy block:
+	row i is nodes[starts[i]:ends[i]]. A read-only sequence of svm_node
+	arrays; a problem built on a block keeps one as x_space, and so does
+	every model trained on it, which keeps the block alive.
+	"""
+	def __init__(self, nodes, starts, ends):
+		self.nodes = nodes
+		self.starts = starts
+		self.ends = ends
+
+	def __len__(self):
+		return len(self.starts)
+
+	def __getitem__(self, i):
+		start = int(self.starts[i])
+		length = int(self.ends[i]) - start
+		return (svm_node * length).from_buffer(self.nodes, start * sizeof(svm_node))
+
+	def __iter__(self):
+		for i in xrange(len(self.starts)):
+			yield self[i]
+
+class svm_node_pool(svm_node_rows):
+	"""
+	svm_node_pool(x [, isKernel]) -> the svm_node rows of a dense 2-D array
+
+	Converts every row of x once, as gen_svm_nodearray would, so that
+	problems over any subset of the rows are only arrays of pointers into
+	the pool (see problem). Models trained on such a problem hold the
+	pool's block through x_space and stay valid after the pool is gone.
+	"""
+	def __init__(self, x, isKernel=None):
+		if np is None:
+			raise ImportError('svm_node_pool needs numpy')
+		x = np.asarray(x, dtype=np.float64)
+		if x.ndim != 2:
+			raise ValueError("x should be a 2-D array")
+
+		if isKernel:
+			## every column, numbered from 0 (the first is 0:serial_number)
+			keep = np.ones(x.shape, dtype=bool)
+			first = 0
+		else:
+			## non-zero columns, numbered from 1
+			keep = x != 0
+			first = 1
+		rows, cols = np.nonzero(keep)
+		lengths = keep.sum(axis=1)
+		ends = np.cumsum(lengths + 1)
+		nodes = np.zeros(ends[-1] if len(x) else 0, dtype=svm_node_dtype)
+		## row r is preceded by the r terminators of the rows before it
+		pos = np.arange(len(rows)) + rows
+		nodes['index'][pos] = cols + first
+		nodes['value'][pos] = x[rows, cols]
+		nodes['index'][ends - 1] = -1
+		svm_node_rows.__init__(self, nodes, ends - lengths - 1, ends)
+
+		## largest index of each row (0 if it is empty), for svm_problem.n
+		self.max_index = np.where(lengths > 0, nodes['index'][np.maximum(ends - 2, 0)], 0)
+		self.addresses = (self.starts * sizeof(svm_node) + nodes.ctypes.data).astype(np.uintp)
+
+	def problem(self, y, rows):
+		"""
+		problem(y, rows) -> svm_problem
+
+		The problem of labels y and the rows of the pool listed in rows,
+		same as svm_problem(y, [x[i] for i in rows], isKernel).
+		"""
+		rows = np.asarray(rows, dtype=np.intp)
+		if len(y) != len(rows):
+			raise ValueError("len(y) != len(rows)")
+		l = len(rows)
+		prob = svm_problem.__new__(svm_problem)
+		prob.l = l
+		prob.x_space = svm_node_rows(self.nodes, self.starts[rows], self.ends[rows])
+		prob.n = int(self.max_index[rows].max()) if l else 0
+		prob.y = (c_double * l)(*y)
+		prob.x = (POINTER(svm_node) * l)()
+		if l:
+			addresses = np.ascontiguousarray(self.addresses[rows])
+			memmove(prob.x, addresses.ctypes.data, l * sizeof(c_void_p))
+		return prob
+
 class svm_parameter(Structure):
 	_names = ["svm_type", "kernel_type", "degree", "gamma", "coef0",
 			"cache_size", "eps", "C", "nr_weight", "weight_label", "weight",
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+"""Check arraydtw against the reference fastdtw module
+
+Runs arraydtw.fastdtw and arraydtw.dtw next to fastdtw.fastdtw and
+fastdtw.dtw on pairs of series of a UCR file and stops at the first
+distance or warping path that differs. Plain python, no test framework:
+
+  python test_arraydtw.py [file [pairs]]
+"""
+
+import os
+import sys
+import numpy as np
+import ucrdata
+import fastdtw
+import arraydtw
+
+RADII = (0, 1, 2)
+
+
+def check(name, expected, got):
+    e_dist, e_path = expected
+    g_dist, g_path = got
+    if e_dist != g_dist or [tuple(p) for p in e_path] != [tuple(p) for p in g_path]:
+        sys.exit('FAIL %s: distance %r, expected %r; paths %s' %(
+                 name, g_dist, e_dist, 'equal' if list(e_path) == list(g_path) else 'differ'))
+
+def main(file_name, pairs):
+    labels, dat = ucrdata.load(file_name, cache=False)
+    rs = np.random.RandomState(0)
+    checked = 0
+    for p in xrange(pairs):
+        a, b = rs.choice(len(dat), 2, replace=False)
+        ## lists of floats, as clamp_main passes them
+        x, y = dat[a].tolist(), dat[b].tolist()
+        for radius in RADII:
+            check('fastdtw(%d, %d, radius=%d)' %(a, b, radius),
+                  fastdtw.fastdtw(x, y, radius=radius), arraydtw.fastdtw(x, y, radius=radius))
+            checked += 1
+        check('dtw(%d, %d)' %(a, b), fastdtw.dtw(x, y), arraydtw.dtw(x, y))
+        ## uneven lengths
+        check('dtw(%d[:-7], %d)' %(a, b), fastdtw.dtw(x[:-7], y), arraydtw.dtw(x[:-7], y))
+        checked += 2
+    print('OK: %d comparisons on %d pairs of %s' %(checked, pairs, file_name))
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.join(here, 'data', 'Gun_Point_TRAIN'),
+         int(sys.argv[2]) if len(sys.argv) > 2 else 10)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""Two-stage producer / consumer pipeline on threads
+
+The producer stage runs in the calling thread while it pulls the input
+iterator; the consumer stage, func, runs on a pool of threads. This only
+pays off when func spends its time outside the GIL, such as in the ctypes
+calls into libsvm. At most backlog items are in flight between the two
+stages (queued, running or finished but waiting for an earlier one), so a
+fast producer blocks instead of piling up work, and results come out in
+input order.
+"""
+
+import sys
+import threading
+import Queue
+from time import time
+
+
+class ThreadPipeline(object):
+
+    def __init__(self, func, threads, backlog=None):
+        self.func = func
+        self.threads = threads
+        self.backlog = backlog if backlog else 2*threads
+        ## seconds spent producing items, in func, and overall
+        self.produce_time = 0.0
+        self.busy_time = 0.0
+        self.wall_time = 0.0
+        self._lock = threading.Lock()
+
+    def _work(self, todo, done):
+        while True:
+            task = todo.get()
+            if task is None:
+                return
+            n, item = task
+            start = time()
+            try:
+                done.put((n, True, self.func(item)))
+            except Exception:
+                done.put((n, False, sys.exc_info()))
+            with self._lock:
+                self.busy_time += time() - start
+
+    def imap(self, items):
+        """Like itertools.imap(func, items), with func run on the threads."""
+        todo, done = Queue.Queue(), Queue.Queue()
+        workers = [threading.Thread(target=self._work, args=(todo, done))
+                   for t in xrange(self.threads)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        start = time()
+        finished = {}
+        sent = emitted = 0
+        items = iter(items)
+        try:
+            while True:
+                if sent - emitted < self.backlog:
+                    produce_start = time()
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        break
+                    self.produce_time += time() - produce_start
+                    todo.put((sent, item))
+                    sent += 1
+                    block = False
+                else:
+                    ## backpressure: wait for the workers
+                    block = True
+                try:
+                    while True:
+                        n, ok, result = done.get(block)
+                        finished[n] = (ok, result)
+                        block = False
+                except Queue.Empty:
+                    pass
+                while emitted in finished:
+                    yield self._result(finished.pop(emitted))
+                    emitted += 1
+            while emitted < sent:
+                while emitted not in finished:
+                    n, ok, result = done.get()
+                    finished[n] = (ok, result)
+                yield self._result(finished.pop(emitted))
+                emitted += 1
+        finally:
+            for w in workers:
+                todo.put(None)
+            ## every thread is done before the caller goes on (and maybe
+            ## exits, tearing down the modules under a daemon thread)
+            for w in workers:
+                w.join()
+            self.wall_time += time() - start
+
+    def _result(self, finished):
+        ok, result = finished
+        if not ok:
+            raise result[0], result[1], result[2]
+        return result
+
+    def stats(self):
+        ## the share of the work of both stages hidden by running them concurrently
+        work = self.produce_time + self.busy_time
+        overlap = max(work - self.wall_time, 0)/work if work else 0.0
+        return ('Thread pipeline: %d threads, %.2fs producing, %.2fs in threads, %.2fs wall, '
+                '%.0f%% of the work overlapped'
+                %(self.threads, self.produce_time, self.busy_time, self.wall_time, overlap*100))
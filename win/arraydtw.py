@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Array based DTW / FastDTW, and exact DTW in a Sakoe-Chiba band
+
+Drop-in replacement for fastdtw.dtw and fastdtw.fastdtw. At every resolution
+the warping window is kept as per-row [start, end) column ranges in integer
+arrays, and FastDTW refines the path in a loop instead of recursing. The
+cumulative costs of the cells in the window live in one flat buffer, filled
+one anti-diagonal per numpy call for wide windows and cell by cell for narrow
+ones. The same additions and comparisons as the reference implementation are
+performed, so distances and paths are identical.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import numpy as np
+
+_ORIGIN = 0  ## position of D[0, 0] in the cost buffer
+_MISSING = 1  ## position of the +inf sentinel used for cells outside the window
+_NARROW = 24  ## below this many cells per anti-diagonal, fill cell by cell
+
+
+def fastdtw(x, y, radius=1, dist=lambda a, b: abs(a - b)):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    min_time_size = radius + 2
+
+    ## halve both series until one is too short, then refine the warping
+    ## path back up one resolution at a time (the recursion of fastdtw.fastdtw)
+    levels = [(x, y)]
+    while len(x) >= min_time_size and len(y) >= min_time_size:
+        x, y = _reduce_by_half(x), _reduce_by_half(y)
+        levels.append((x, y))
+
+    distance, rows, cols = _dtw(x, y, np.zeros(len(x), dtype=np.intp),
+                                np.full(len(x), len(y), dtype=np.intp), dist)
+    for x, y in reversed(levels[:-1]):
+        starts, ends = _expand_window(rows, cols, len(x), len(y), radius)
+        distance, rows, cols = _dtw(x, y, starts, ends, dist)
+    return (distance, list(zip(rows.tolist(), cols.tolist())))
+
+
+def dtw(x, y, window=None, dist=lambda a, b: (a - b)**2):
+    """dtw(x, y [, window, dist]) -> (distance, path)
+
+    window is either a list of (i, j) cells (as in fastdtw.dtw) or a pair of
+    integer arrays (starts, ends) giving the columns [starts[i], ends[i]) of
+    row i. dist is applied element-wise to numpy arrays.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    starts, ends = _as_ranges(window, len(x), len(y))
+    distance, rows, cols = _dtw(x, y, starts, ends, dist)
+    return (distance, list(zip(rows.tolist(), cols.tolist())))
+
+
+def _dtw(x, y, starts, ends, dist):
+    """DTW within the window [starts[i], ends[i]) of each row i of x, the
+    warping path is returned as arrays of rows and columns."""
+    len_x, len_y = len(x), len(y)
+    if not (starts[-1] < len_y <= ends[-1]):
+        ## (len_x - 1, len_y - 1) is not in the window
+        return float('inf'), starts[:0], starts[:0]
+
+    ## cells of the window, row-major
+    widths = ends - starts
+    offsets = np.zeros(len_x + 1, dtype=np.intp)
+    np.cumsum(widths, out=offsets[1:])
+    n_cells = offsets[-1]
+    I = np.repeat(np.arange(len_x), widths)
+    J = np.arange(n_cells) - np.repeat(offsets[:-1] - starts, widths)
+    cost = dist(x[I], y[J])
+
+    if n_cells < _NARROW * (len_x + len_y - 1):
+        D, path = _fill_rows(cost, starts, ends, offsets)
+    else:
+        D, path = _fill_diagonals(cost, I, J, starts, ends, offsets)
+    return (D[-1], I[path], J[path])
+
+
+def _fill_rows(cost, starts, ends, offsets):
+    """Row by row, cell by cell: for narrow windows a numpy call per
+    anti-diagonal costs more than it saves."""
+    cost = cost.tolist()
+    starts, ends, offsets = starts.tolist(), ends.tolist(), offsets.tolist()
+    inf = float('inf')
+    D = [inf] * len(cost)
+    back = bytearray(len(cost))  ## 0 up, 1 left, 2 diagonal
+    ## row -1 only holds the origin, at column -1
+    ps, pe, po = -1, 0, -1
+    p = 0
+    for i in xrange(len(starts)):
+        s, e = starts[i], ends[i]
+        left = inf
+        for j in xrange(s, e):
+            up = D[po + j - ps] if ps <= j < pe else inf
+            if ps <= j - 1 < pe:
+                diag = D[po + j - 1 - ps] if i else 0.0
+            else:
+                diag = inf
+            m, b = up, 0
+            if left < m:
+                m, b = left, 1
+            if diag < m:
+                m, b = diag, 2
+            left = D[p] = m + cost[p]
+            back[p] = b
+            p += 1
+        ps, pe, po = s, e, offsets[i]
+
+    i, j = len(starts) - 1, ends[-1] - 1
+    p = len(cost) - 1
+    path = []
+    while True:
+        path.append(p)
+        if back[p] == 1:
+            p -= 1
+            j -= 1
+            continue
+        if i == 0:
+            break
+        j -= back[p] // 2
+        i -= 1
+        p = offsets[i] + j - starts[i]
+    return D, path[::-1]
+
+
+def _fill_diagonals(cost, I, J, starts, ends, offsets):
+    """One numpy call per anti-diagonal, every cell on it only depends on
+    the two previous ones."""
+    n_cells = len(cost)
+    ## lay the buffer out by anti-diagonal
+    diag_id = I + J
+    order = np.argsort(diag_id, kind='mergesort')
+    position = np.empty(n_cells + 2, dtype=np.intp)
+    position[0], position[1] = _ORIGIN, _MISSING
+    position[2 + order] = np.arange(2, n_cells + 2)
+    I, J = I[order], J[order]
+
+    up = position[_lookup(I - 1, J, starts, ends, offsets)]
+    left = position[_lookup(I, J - 1, starts, ends, offsets)]
+    diag = position[_lookup(I - 1, J - 1, starts, ends, offsets)]
+
+    D = np.empty(n_cells + 2)
+    D[_ORIGIN], D[_MISSING] = 0, np.inf
+    cost = cost[order]
+
+    bounds = np.flatnonzero(np.diff(diag_id[order])) + 1
+    bounds = np.concatenate(([0], bounds, [n_cells]))
+    tmp = np.empty(n_cells)
+    for s, e in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        t = tmp[:e - s]
+        np.minimum(D[up[s:e]], D[left[s:e]], out=t)
+        np.minimum(t, D[diag[s:e]], out=t)
+        np.add(t, cost[s:e], out=D[s + 2:e + 2])
+
+    ## back pointers, ties resolved in the same order as fastdtw.dtw
+    d_up, d_left, d_diag = D[up], D[left], D[diag]
+    back = np.where((d_up <= d_left) & (d_up <= d_diag), up,
+                    np.where(d_left <= d_diag, left, diag))
+    back = (back - 2).tolist()
+    p = position[n_cells + 1] - 2  ## the last cell, row-major
+    path = []
+    while p >= 0:
+        path.append(p)
+        p = back[p]
+    ## back to row-major cell indices
+    path = order[path[::-1]]
+    return D[position[2:]].tolist(), path
+
+
+def band_dtw(x, y, window, threshold=float('inf'), squared=True):
+    """band_dtw(x, y, window [, threshold, squared]) -> distance
+
+    Exact DTW of x and y restricted to the Sakoe-Chiba band |i - j| <= window,
+    with (a - b)**2 (or abs(a - b) if not squared) as the cost of a cell.
+    Only two rolling rows of length 2*window+1 are kept, and inf is returned
+    as soon as a whole row exceeds threshold (early abandoning).
+    """
+    inf = float('inf')
+    len_x, len_y = len(x), len(y)
+    if abs(len_x - len_y) > window:
+        return inf
+    width = 2*window + 1
+    ## cell (i, j) is kept at position j - i + window + 1, positions 0 and
+    ## width + 1 are +inf sentinels
+    prev = [inf]*(width + 2)
+    prev[window + 1] = 0.0  ## D[-1, -1], the diagonal of (0, 0)
+    curr = [inf]*(width + 2)
+    for i in xrange(len_x):
+        xi = x[i]
+        lo = max(0, window - i)
+        hi = min(width, len_y - i + window)
+        j = i + lo - window
+        if squared:
+            cost = [(xi - yj)**2 for yj in y[j:j + hi - lo]]
+        else:
+            cost = [abs(xi - yj) for yj in y[j:j + hi - lo]]
+        left = curr[lo] = inf
+        p = lo + 1
+        for c in cost:
+            best = prev[p + 1]
+            if left < best:
+                best = left
+            if prev[p] < best:
+                best = prev[p]
+            left = curr[p] = best + c
+            p += 1
+        curr[p] = inf
+        if min(curr[lo + 1:p]) > threshold:
+            return inf
+        prev, curr = curr, prev
+    return prev[len_y - len_x + window + 1]
+
+
+def _as_ranges(window, len_x, len_y):
+    if window is None:
+        return (np.zeros(len_x, dtype=np.intp),
+                np.full(len_x, len_y, dtype=np.intp))
+    if isinstance(window, tuple) and len(window) == 2 and \
+            isinstance(window[0], np.ndarray):
+        return (np.asarray(window[0], dtype=np.intp),
+                np.asarray(window[1], dtype=np.intp))
+    cells = np.asarray(window, dtype=np.intp).reshape(-1, 2)
+    starts = np.full(len_x, len_y, dtype=np.intp)
+    ends = np.zeros(len_x, dtype=np.intp)
+    np.minimum.at(starts, cells[:, 0], cells[:, 1])
+    np.maximum.at(ends, cells[:, 0], cells[:, 1] + 1)
+    np.minimum(starts, ends, out=starts)
+    return starts, ends
+
+
+def _lookup(i, j, starts, ends, offsets):
+    """Index (+2) of cell (i, j) in the row-major cell list, the origin for
+    (-1, -1) and the +inf sentinel for anything outside the window."""
+    ic = np.clip(i, 0, len(starts) - 1)
+    inside = (i >= 0) & (j >= starts[ic]) & (j < ends[ic])
+    idx = np.where(inside, offsets[ic] + j - starts[ic] + 2, _MISSING)
+    idx[(i == -1) & (j == -1)] = _ORIGIN
+    return idx
+
+
+def _reduce_by_half(x):
+    ## same averaging as fastdtw.__reduce_by_half
+    i = np.arange(0, len(x), 2) // 2
+    return (x[i] + x[1 + i]) / 2
+
+
+def _expand_window(rows, cols, len_x, len_y, radius):
+    """Per-row column ranges equivalent to fastdtw.__expand_window: the
+    coarse path dilated by radius, then projected to the finer resolution."""
+    n_rows = rows[-1] + 1
+    ## the path is monotone, so each coarse row covers one run of columns
+    row_lo = np.full(n_rows, len_y, dtype=np.intp)
+    row_hi = np.zeros(n_rows, dtype=np.intp)
+    np.minimum.at(row_lo, rows, cols)
+    np.maximum.at(row_hi, rows, cols)
+    coarse = np.arange(n_rows)
+    lo = row_lo[np.maximum(coarse - radius, 0)] - radius
+    hi = row_hi[np.minimum(coarse + radius, n_rows - 1)] + radius
+
+    fine = np.arange(len_x) // 2
+    starts = np.maximum(2 * lo[fine], 0)
+    ends = np.minimum(2 * hi[fine] + 2, len_y)
+    return starts, ends
@@ -6,12 +6,32 @@
 
 import os
 import sys
+import math
 import argparse
-import pylshbox
-import fastdtw
+import itertools
+import collections
+import numpy as np
+import multiprocessing
+try:
+    import pylshbox
+except ImportError:
+    ## no compiled LSHBOX: the numpy implementation of its indexes
+    import numpylsh as pylshbox
+import arraydtw
+import dtwknn
+import euclideanknn
+import dtwmatrix
+import ucrdata
+import threadpipe
+import kernelmatrix
+import modelcache
+import lshindex
+import fourierfeatures
+import filecache
 from datetime import datetime
 from time import time
 from svmpy import svmutil as svm
+from svmpy import batchsvm
 
 def parse_svm_parms(parms):
     parm_list = parms.split(',')
@@ -22,6 +42,11 @@ def parse_svm_parms(parms):
         parm_parsed.extend(p)
     return ' '.join(parm_parsed)
 
+def linear_svm_parms(parms):
+    ## the same SVM parameters with a linear kernel
+    kept = [p for p in parms.split(',') if p.split(':')[0] not in ('t', 'g', 'd', 'r')]
+    return ','.join(kept + ['t:0'])
+
 def parse_lsh_parms(parms):
     parm_list = parms.split(',')
     parm_parsed = {}
@@ -50,20 +75,351 @@ def discreteHaarWaveletTransform(x):
         length >>= 1
 
 
-def dtw_dist_mat(dat):
+## FastDTW settings of the DTW features, part of the cache key
+DTW_RADIUS = 1
+DTW_DIST = 'abs'
+
+## queries sent to a query worker at a time
+QUERY_CHUNK = 8
+## queries whose SVMs are trained together by --svm_solver batch; the
+## memory of each solve is bounded by batchsvm.BATCH_ELEMENTS
+QUERY_BATCH = 256
+
+## training set and Sakoe-Chiba band of the DTW tile workers,
+## set once per process by the pool initializer
+_tile_dat = None
+_tile_band = None
+
+def _init_dtw_worker(dat, band=None):
+    global _tile_dat, _tile_band
+    _tile_dat = dat
+    _tile_band = band
+
+def dtw_settings(band=None):
+    if band is None:
+        return 'radius=%d;dist=%s' %(DTW_RADIUS, DTW_DIST)
+    return 'band=%d;dist=%s' %(band, DTW_DIST)
+
+def dtw_tiles(length, jobs):
+    ## split the upper triangle into square tiles, several per worker
+    ## so that the (smaller) diagonal tiles even out
+    blocks = max(1, int(math.ceil(math.sqrt(8.0*jobs))))
+    size = int(math.ceil(length*1.0/blocks))
+    return [(i, min(i+size, length), j, min(j+size, length))
+            for i in xrange(0, length, size) for j in xrange(i, length, size)]
+
+def dtw_pair(dat, i, j, band=None):
+    ## FastDTW, or exact DTW within a Sakoe-Chiba band if one is given
+    if band is None:
+        return arraydtw.fastdtw(dat[i], dat[j], radius=DTW_RADIUS)[0]
+    return arraydtw.band_dtw(dat[i], dat[j], band, squared=False)
+
+def dtw_tile(tile):
+    i_s, i_e, j_s, j_e = tile
+    dat = _tile_dat
+    dists = []
+    for i in xrange(i_s, i_e):
+        for j in xrange(max(i+1, j_s), j_e):
+            dists.append(dtw_pair(dat, i, j, _tile_band))
+    return tile, dists
+
+def dtw_dist_mat(dat, jobs=1, band=None):
     length = len(dat)
-    dtw_distances = [[0 for x in xrange(length)] for x in xrange(length)]
-    sys.stderr.write('Precomputing DTW distance matrix [%dx%d] for training set...\n' %(length, length))
-    for i in xrange(length):
+    dtw_distances = dtwmatrix.DistanceMatrix(length)
+    sys.stderr.write('Precomputing DTW distance matrix [%dx%d] for training set (%d jobs)...\n' %(length, length, jobs))
+    tiles = dtw_tiles(length, jobs)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _init_dtw_worker, (dat, band))
+        results = pool.imap_unordered(dtw_tile, tiles)
+    else:
+        _init_dtw_worker(dat, band)
+        results = itertools.imap(dtw_tile, tiles)
+    total_pairs = length*(length-1)/2
+    done_pairs = 0
+    for (i_s, i_e, j_s, j_e), dists in results:
+        start = 0
+        for i in xrange(i_s, i_e):
+            row_s = max(i+1, j_s)
+            row_len = max(j_e - row_s, 0)
+            dtw_distances.set_row(i, row_s, dists[start:start+row_len])
+            start += row_len
+        done_pairs += len(dists)
         sys.stderr.write('\r')
-        sys.stderr.write("[%-50s] %d%%" % ('='*(50*(i+1)/length), (i+1)*100*1.0/length))
+        sys.stderr.write("[%-50s] %d%%" % ('='*(50*done_pairs/max(total_pairs, 1)), done_pairs*100.0/max(total_pairs, 1)))
         sys.stderr.flush()
-        for j in xrange(i+1,length):
-            dist = (fastdtw.fastdtw(dat[i], dat[j]))[0]
-            dtw_distances[i][j] = dtw_distances[j][i] = dist
+    if jobs > 1:
+        pool.close()
+        pool.join()
     sys.stderr.write("\n")
     return dtw_distances
 
+def read_queries(f, isTesting):
+    ## (class label, series) of each line, the label is 1 in prediction mode
+    for l in f:
+        line = l.strip().split(',')
+        if isTesting:
+            yield int(line[0]), map(float, line[1:])
+        else:
+            yield 1, map(float, line)
+
+def knn_search(mat, queries, k):
+    ## neighbours of every query, in one call for indexes that support it
+    if hasattr(mat, 'query_batch'):
+        return mat.query_batch(queries, k)
+    return [mat.query(test_dat, 2, k)[0] for test_dat in queries]
+
+def train_features(train_mat, feature):
+    ## the features of every training series, None for DTW features,
+    ## which depend on the neighbours of each query
+    if feature == 'dtw':
+        return None
+    if feature == 'dwt':
+        return np.array([ discreteHaarWaveletTransform(row) for row in train_mat.tolist() ])
+    return train_mat
+
+def train_nodes(train_features, svm_parms, precompute=False):
+    """The libsvm nodes of the features of every training series, built
+    once so that the per-query problems only point into them. None for
+    DTW features.
+
+    With precompute, the kernel matrix of the features instead, whose
+    blocks the per-query SVMs are trained on with -t 4.
+    """
+    if train_features is None:
+        return None
+    train_mat = train_features
+    param = svm.svm_parameter(parse_svm_parms(svm_parms))
+    if precompute:
+        return kernelmatrix.KernelMatrix(train_mat, param)
+    return svm.svm_node_pool(train_mat, isKernel=(param.kernel_type == svm.PRECOMPUTED))
+
+def svm_problem(kNN_index, train_class_label, train_nodes, feature, svm_parms, dtw_distances=None):
+    """The features of the neighbours as an SVM training problem, and the
+    parameters to train it with.
+
+    Returns (prob, param).
+    """
+    kNN_labels = [ train_class_label[i] for i in kNN_index]
+    param = svm.svm_parameter(parse_svm_parms(svm_parms))
+    if feature == 'dtw':
+        ## retrieve dtw feature matrix
+        prob = svm.svm_problem.from_dense(kNN_labels, dtw_distances.submatrix(kNN_index),
+                                          isKernel=(param.kernel_type == svm.PRECOMPUTED))
+    else:
+        prob = train_nodes.problem(kNN_labels, kNN_index)
+    return prob, param
+
+def top_classes(kNN_index, train_class_label, m):
+    """The neighbours of the m classes most frequent among them, ties
+    going to the class of the nearest neighbour, in their original order."""
+    counts = collections.Counter(train_class_label[i] for i in kNN_index)
+    rank = {}
+    for i in kNN_index:
+        rank.setdefault(train_class_label[i], len(rank))
+    kept = set(sorted(counts, key=lambda c: (-counts[c], rank[c]))[:m])
+    return [i for i in kNN_index if train_class_label[i] in kept]
+
+def ovo_work(kNN_labels):
+    ## (binary SVMs, kernel values of their Q matrices) of libsvm's
+    ## one-against-one training on these labels
+    counts = collections.Counter(kNN_labels).values()
+    pairs = list(itertools.combinations(counts, 2))
+    return len(pairs), sum((n_s + n_t)**2 for n_s, n_t in pairs)
+
+## index, training set and settings of the query workers, set before the
+## pool is created so that forked workers inherit them instead of having
+## them pickled
+_query_state = None
+
+def model_key(kNN_index, feature, svm_parms):
+    ## the training set of a per-query SVM; the order of the neighbours
+    ## does not matter, except for DTW features where it orders the columns
+    if feature == 'dtw':
+        return feature, svm_parms, tuple(kNN_index)
+    return feature, svm_parms, tuple(sorted(kNN_index))
+
+def prepare_query(task):
+    """First half of classify_query: find the neighbours and, unless they
+    all belong to one class, build their SVM problem or find an SVM trained
+    on the same neighbours in the model cache.
+
+    With --top_classes, only the neighbours of the most frequent classes
+    are kept, and work is the one-against-one work (ovo_work) of all the
+    neighbours and of those kept.
+
+    Returns (class label, label or None,
+             (model, prob, param, series, neighbours, cache key, build time, work) or None);
+    both are None if the index found no neighbour, the query is then
+    unclassified.
+    """
+    test_class_label, test_dat, kNN_index = task
+    mat, k, train_class_label, train_nodes, feature, svm_parms, dtw_distances, feature_map, m, model_cache = _query_state
+    if kNN_index is None:
+        kNN_index = mat.query(test_dat, 2, k)[0]
+    if not len(kNN_index):
+        ## LSH found no candidate
+        return test_class_label, None, None
+
+    ## if kNN are all of one class, just report that
+    tmp_label = train_class_label[kNN_index[0]]
+    if all(train_class_label[i] == tmp_label for i in kNN_index):
+        return test_class_label, tmp_label, None
+
+    ## else run the eager learning part
+    train_time_s = time()
+    work = None
+    if m > 0:
+        kept = top_classes(kNN_index, train_class_label, m)
+        work = (ovo_work([train_class_label[i] for i in kNN_index]),
+                ovo_work([train_class_label[i] for i in kept]))
+        kNN_index = kept
+    model = prob = param = key = None
+    if model_cache is not None:
+        key = model_key(kNN_index, feature, svm_parms)
+        cached = model_cache.get(key)
+        if cached is not None:
+            ## the neighbours in the order the model was trained on
+            model, kNN_index = cached
+    if model is None:
+        prob, param = svm_problem(kNN_index, train_class_label, train_nodes, feature, svm_parms, dtw_distances)
+    if feature_map is not None:
+        test_dat = feature_map.transform(test_dat).tolist()
+    if isinstance(train_nodes, kernelmatrix.KernelMatrix):
+        ## the model sees the query through its kernel values with the neighbours
+        test_dat = train_nodes.query_row(test_dat, kNN_index)
+    return test_class_label, None, (model, prob, param, test_dat, kNN_index, key, time() - train_time_s, work)
+
+def finish_query(prepared):
+    """Second half of classify_query: train and apply the SVM, if any.
+    Apart from building the training problem, this is spent in libsvm.
+
+    Returns (class label, predicted label, train_time, test_time, trained, work),
+    the times are None if the label was assigned lazily (or the query is
+    unclassified, the predicted label is then None too), trained tells
+    whether svm_train was called, work is that of prepare_query.
+    """
+    test_class_label, p_label, svm_task = prepared
+    if svm_task is None:
+        return test_class_label, p_label, None, None, False, None
+    model, prob, param, test_dat, kNN_index, key, build_time, work = svm_task
+    ## training, unless the model came from the cache
+    train_time_s = time()
+    trained = model is None
+    if trained:
+        model = svm.svm_train(prob, param)
+        if key is not None:
+            _query_state[-1].put(key, model, kNN_index)
+    train_time_e = time()
+    ## testing
+    test_time_s = time()
+    p_label, p_acc, p_val = svm.svm_predict([test_class_label], [test_dat], model ,'-q')
+    test_time_e = time()
+    return test_class_label, p_label[0], build_time + train_time_e - train_time_s, test_time_e - test_time_s, trained, work
+
+def classify_query(task):
+    ## (class label, series, neighbours or None to look them up)
+    ##   -> (class label, predicted label, train_time, test_time, trained, work)
+    return finish_query(prepare_query(task))
+
+def classify_batches(tasks, size):
+    """classify_query for size queries at a time, with the SVMs of each
+    batch trained and applied together by batchsvm instead of libsvm. The
+    per-query times are the batch times shared evenly.
+    """
+    mat, k, train_class_label, train_features, feature, svm_parms, dtw_distances, feature_map, m, model_cache = _query_state
+    tasks = iter(tasks)
+    while True:
+        batch = list(itertools.islice(tasks, size))
+        if not batch:
+            return
+        results = [None]*len(batch)
+        problems = []
+        problem_of = {}
+        keys = {}
+        works = {}
+        for n, (test_class_label, test_dat, kNN_index) in enumerate(batch):
+            if kNN_index is None:
+                kNN_index = mat.query(test_dat, 2, k)[0]
+            if not len(kNN_index):
+                ## LSH found no candidate: unclassified
+                results[n] = (test_class_label, None, None, None, False, None)
+                continue
+            kNN_labels = [ train_class_label[i] for i in kNN_index]
+            ## if kNN are all of one class, just report that
+            if all(label == kNN_labels[0] for label in kNN_labels):
+                results[n] = (test_class_label, kNN_labels[0], None, None, False, None)
+                continue
+            if m > 0:
+                kept = top_classes(kNN_index, train_class_label, m)
+                works[n] = (ovo_work(kNN_labels), ovo_work([train_class_label[i] for i in kept]))
+                kNN_index = kept
+                kNN_labels = [ train_class_label[i] for i in kNN_index]
+            ## one SVM for the queries of the batch with the same neighbours
+            key = model_key(kNN_index, feature, svm_parms)
+            if key not in keys:
+                keys[key] = len(problems)
+                if feature == 'dtw':
+                    problems.append((kNN_labels, dtw_distances.submatrix(kNN_index)))
+                else:
+                    problems.append((kNN_labels, train_features[kNN_index]))
+            problem_of[n] = keys[key]
+        if problems:
+            train_time_s = time()
+            models = batchsvm.svm_train_batch(problems, parse_svm_parms(svm_parms))
+            train_time = (time() - train_time_s)/len(problem_of)
+            test_time_s = time()
+            pending = sorted(problem_of)
+            test_dats = [batch[n][1] for n in pending]
+            if feature_map is not None:
+                test_dats = feature_map.transform(test_dats)
+            p_labels, p_vals = batchsvm.svm_predict_batch([models[problem_of[n]] for n in pending], test_dats)
+            test_time = (time() - test_time_s)/len(problem_of)
+            trained = set()
+            for n, p_label in itertools.izip(pending, p_labels):
+                results[n] = (batch[n][0], p_label, train_time, test_time, problem_of[n] not in trained, works.get(n))
+                trained.add(problem_of[n])
+        for result in results:
+            yield result
+
+def share_neighbours(kNN_indexes, train_class_label, overlap):
+    """Group the queries whose neighbours are not all of one class: a query
+    joins the group whose first member's neighbours overlap most with its
+    own, if that Jaccard index is at least overlap, else it starts a new
+    group. All members of a group are then classified by one SVM trained
+    on the union of their neighbours.
+
+    Returns the neighbours to train each query's SVM on (its own if they
+    are all of one class, or if there are none) and the number of groups.
+    """
+    leaders = []  ## neighbour set of the first member of each group
+    unions = []  ## neighbours of the members of each group, in order of appearance
+    leading = {}  ## training series -> groups whose first member has it as neighbour
+    groups = []
+    for kNN_index in kNN_indexes:
+        if len(set(train_class_label[i] for i in kNN_index)) <= 1:
+            groups.append(None)
+            continue
+        neighbours = set(kNN_index)
+        shared = {}
+        for i in neighbours:
+            for g in leading.get(i, ()):
+                shared[g] = shared.get(g, 0) + 1
+        best, best_overlap = None, overlap
+        for g in sorted(shared):
+            jaccard = shared[g]*1.0/(len(neighbours) + len(leaders[g]) - shared[g])
+            if jaccard > best_overlap or (jaccard == best_overlap and best is None):
+                best, best_overlap = g, jaccard
+        if best is None:
+            best = len(leaders)
+            leaders.append(neighbours)
+            unions.append([])
+            for i in neighbours:
+                leading.setdefault(i, []).append(best)
+        union = unions[best]
+        union.extend(i for i in kNN_index if i not in union)
+        groups.append(best)
+    return [kNN_index if g is None else unions[g] for kNN_index, g in itertools.izip(kNN_indexes, groups)], len(leaders)
+
 def main(arguments):
     elapsed_time_s = time()
     parser = argparse.ArgumentParser(description=__doc__)
@@ -84,41 +440,134 @@ def main(arguments):
     parser.add_argument("-l", "--lsh_method",
                         dest="lsh_method",
                         default = 'psd',
-                        help="The lsh method used: psd (Euclidean)/rhp (Cosine) [psd]")
+                        help="The lsh method used: psd (Euclidean)/rhp (Cosine)/dtw (exact DTW, no hashing)/ed (exact z-normalized Euclidean, no hashing) [psd]")
     parser.add_argument("-f", "--feature",
                         dest="feature",
                         default = None,
-                        help="Feature based method: dtw (DTW distances), dwt (Discrete Wavelet Transformation) [Raw data]")
+                        help="Feature based method: dtw (DTW distances), dwt (Discrete Wavelet Transformation), rff (random Fourier features approximating the RBF kernel of -s t:2, the SVMs then use a linear kernel) [Raw data]")
     parser.add_argument("-p", "--lsh_parms",
                         dest="lsh_parms",
                         default = 'M:521,L:20,T:2,W:5',
-                        help="Parameters used by LSHBOX (parm1:val1,parm2:val2) [M:521,L:20,T:2,W:5]")
+                        help="Parameters used by LSHBOX (parm1:val1,parm2:val2), P:n probes n more buckets per table (numpylsh only) [M:521,L:20,T:2,W:5]")
     parser.add_argument("-s", "--svm_parms",
                         dest="svm_parms",
                         default = 't:0,q',
                         help="Parameters used by LIBSVM (parm1:val1,parm2:val2) [t:0]")
+    parser.add_argument("--index",
+                        dest="index",
+                        default = None,
+                        help="Keep the LSH index (-l psd/rhp) in this file: load it if it was built from the same database and parameters, else build and save it there [a temporary file]")
+    parser.add_argument("--reuse_index",
+                        action = "store_true",
+                        dest="reuse_index",
+                        help="Keep the LSH index next to the database, and load it in later runs with the same database and parameters (--index chooses the file)")
     parser.add_argument("--prediction",
                         action = "store_false",
                         dest="isTesting",
                         help="If not specified, will treat the first column in query as class label.")
+    parser.add_argument("--batch",
+                        action = "store_true",
+                        dest="batch",
+                        help="Read all queries first and find their nearest neighbours in one pass, instead of one query at a time")
+    parser.add_argument("-j", "--jobs",
+                        dest="jobs",
+                        default = 1,
+                        type = int,
+                        help="Number of worker processes for the DTW distance matrix and for classifying the queries, 0 for all cores [1]")
+    parser.add_argument("--svm_threads",
+                        dest="svm_threads",
+                        default = 0,
+                        type = int,
+                        help="Train and apply the per-query SVMs on this many threads while the main thread looks up neighbours; -j then only applies to the DTW distance matrix [0: no threads]")
+    parser.add_argument("--precompute_kernel",
+                        action = "store_true",
+                        dest="precompute_kernel",
+                        help="Compute the SVM kernel (-s t:...) between all training series once, and train the per-query SVMs on it as a precomputed kernel (t:4); not for DTW features")
+    parser.add_argument("--svm_solver",
+                        dest="svm_solver",
+                        default = 'libsvm',
+                        choices = ['libsvm', 'batch'],
+                        help="libsvm, or batch: train the SVMs of many queries at once with a vectorized solver (C-SVC, linear or RBF kernel, in this process) [libsvm]")
+    parser.add_argument("--top_classes",
+                        dest="top_classes",
+                        nargs = '?',
+                        const = 2,
+                        default = 0,
+                        type = int,
+                        help="Train the per-query SVM only on the neighbours of the M classes most frequent among them [0: all classes; M=2 if given without a value]",
+                        metavar = 'M')
+    parser.add_argument("--model_cache",
+                        dest="model_cache",
+                        default = 0,
+                        type = int,
+                        help="Keep up to this many trained SVMs, and reuse them for queries with the same nearest neighbours [0: no cache]")
+    parser.add_argument("--share_overlap",
+                        dest="share_overlap",
+                        default = 0,
+                        type = float,
+                        help="Share one SVM among the queries whose nearest neighbours overlap by at least this Jaccard index (0-1], trained on the union of their neighbours; lower values train fewer SVMs. Implies --batch [0: one SVM per query]")
+    parser.add_argument("--rff_components",
+                        dest="rff_components",
+                        default = 100,
+                        type = int,
+                        help="Number of random Fourier features (-f rff) [100]")
+    parser.add_argument("--rff_seed",
+                        dest="rff_seed",
+                        default = 0,
+                        type = int,
+                        help="Seed of the random Fourier feature map (-f rff) [0]")
+    parser.add_argument("--dtw_cache",
+                        dest="dtw_cache",
+                        default = None,
+                        help="Folder for the cached DTW distance matrix of the database [folder of the database]")
+    parser.add_argument("--dtw_window",
+                        dest="dtw_window",
+                        default = 0.1,
+                        type = float,
+                        help="Sakoe-Chiba band of the DTW neighbour search (-l dtw) and of --dtw_band, as a fraction of the series length [0.1]")
+    parser.add_argument("--dtw_band",
+                        action = "store_true",
+                        dest="dtw_band",
+                        help="Compute the DTW features (-f dtw) exactly within the --dtw_window band instead of with FastDTW")
+    parser.add_argument("--dtw_lazy",
+                        action = "store_true",
+                        dest="dtw_lazy",
+                        help="Compute a DTW distance only when a query first needs it, instead of the whole matrix of the database")
+    parser.add_argument("--dtw_memo",
+                        dest="dtw_memo",
+                        default = 1000000,
+                        type = int,
+                        help="Maximum number of DTW distances kept in memory with --dtw_lazy [1000000]")
+    parser.add_argument("--dtw_persist",
+                        action = "store_true",
+                        dest="dtw_persist",
+                        help="With --dtw_lazy, keep the computed DTW distances in a partial cache reused by later runs (queries are then classified in one process)")
     parser.add_argument('-o', '--outfile', help="Output file", dest = 'outfile',
                         default=sys.stdout, type=argparse.FileType('w'))
     
     ## read input file (convert it to a list)
     args = parser.parse_args(arguments)
-    train_class_label = []
-    train_dat = []
-
-    with open(args.database, 'rU') as f:
-        for l in f:
-            line = l.strip().split(',')
-            train_class_label.append(int(line[0]))
-            train_dat.append(map(float,line[1:]))
+    if args.share_overlap > 0:
+        args.batch = True
+    if 'P' in parse_lsh_parms(args.lsh_parms) and not getattr(pylshbox, 'MULTI_PROBE', False):
+        sys.exit('%s has no multi-probe queries (P), use numpylsh\n' %(pylshbox.__name__))
+    if (args.index or args.reuse_index) and args.lsh_method not in ('psd', 'rhp'):
+        sys.exit('Only the LSH indexes (-l psd, rhp) can be saved\n')
+    if args.precompute_kernel and args.feature == 'dtw':
+        sys.exit('Cannot precompute the kernel of DTW features\n')
+    if args.feature == 'rff' and svm.svm_parameter(parse_svm_parms(args.svm_parms)).kernel_type != svm.RBF:
+        sys.exit('Random Fourier features approximate the RBF kernel, use -s t:2\n')
+    if args.precompute_kernel and args.svm_solver == 'batch':
+        sys.exit('The batch SVM solver does not take a precomputed kernel\n')
+    train_class_label, train_mat = ucrdata.load(args.database)
+    train_class_label = train_class_label.tolist()
+    train_dat = train_mat.tolist()
     if args.k == -1:
         k = min( int(0.2*len(train_class_label)), 100 )
         k = max(k, 10)
     else:
         k = args.k
+    jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
 
     
     total_train_time = 0
@@ -137,94 +586,224 @@ def main(arguments):
 
     sys.stderr.write(' '.join(['Using', tmp_folder , 'as temp folder ... \n']))
     sys.stderr.write('Number of Nearest Neighbours (K): %d \n' %(k))
-    sys.stderr.write('LSH method: %s \n' %(args.lsh_method))
+    sys.stderr.write('LSH method: %s (%s) \n' %(args.lsh_method, pylshbox.__name__))
     sys.stderr.write('LSH parameters: %s \n' %(args.lsh_parms))
     sys.stderr.write('SVM parameters: %s \n' %(args.svm_parms))
     sys.stderr.write('Features used: %s \n' %(args.feature))
     tmp_index = tmp_folder + 'lsh.index'
     
     index_time_s = time()
+    dtw_window = int(args.dtw_window*len(train_dat[0]))
+    dtw_band = dtw_window if args.dtw_band else None
+    dtw_distances = None
     lsh_parms = parse_lsh_parms(args.lsh_parms)
+    ## the LSH index loads its file if it exists, else builds and saves it
+    index_path = tmp_index
+    index_manifest = None
+    if args.index or args.reuse_index:
+        index_manifest = lshindex.manifest(args.database, args.lsh_method, lsh_parms,
+                                           pylshbox.__name__, train_mat.shape)
+        index_path = args.index or lshindex.cache_path(args.database, index_manifest)
+        try:
+            if lshindex.reusable(index_path, index_manifest):
+                sys.stderr.write('Loading LSH index %s \n' %(index_path))
+                index_manifest = None
+            else:
+                sys.stderr.write('Building LSH index %s \n' %(index_path))
+        except ValueError as e:
+            if args.index:
+                os.rmdir(tmp_folder)
+                sys.exit('Cannot use the LSH index: %s\n' %(e))
+            ## a stale index in the default place is rebuilt
+            sys.stderr.write('Rebuilding LSH index: %s \n' %(e))
+            lshindex.remove(index_path)
+    ## numpylsh takes the matrix as it is, LSHBOX a list of lists
+    lsh_dat = train_mat if pylshbox.__name__ == 'numpylsh' else train_dat
+    lsh_time_s = time()
     if args.lsh_method == 'rhp':
         mat = pylshbox.rhplsh()
-        mat.init_mat(train_dat, tmp_index, int(lsh_parms['M']), int(lsh_parms['L']), int(lsh_parms['N']))
+        mat.init_mat(lsh_dat, index_path, int(lsh_parms['M']), int(lsh_parms['L']), int(lsh_parms['N']))
     elif args.lsh_method == 'psd':
         mat = pylshbox.psdlsh()
-        mat.init_mat(train_dat, tmp_index, int(lsh_parms['M']), int(lsh_parms['L']), int(lsh_parms['T']), float(lsh_parms['W']))
+        mat.init_mat(lsh_dat, index_path, int(lsh_parms['M']), int(lsh_parms['L']), int(lsh_parms['T']), float(lsh_parms['W']))
+    elif args.lsh_method == 'dtw':
+        mat = dtwknn.DTWSearch()
+        mat.init_mat(train_dat, dtw_window)
+    elif args.lsh_method == 'ed':
+        mat = euclideanknn.EarlyAbandonSearch()
+        mat.init_mat(train_mat)
     else:
         os.rmdir(tmp_folder)
-        sys.exit('Wrong LSH method! Use rhp or psd\n')
+        sys.exit('Wrong LSH method! Use rhp, psd, dtw or ed\n')
+    if args.lsh_method in ('psd', 'rhp'):
+        sys.stderr.write('LSH index ready in %.3fs \n' %(time() - lsh_time_s))
+        if 'P' in lsh_parms:
+            ## multi-probe queries
+            mat.probes = int(lsh_parms['P'])
+    if index_manifest is not None:
+        ## the index was built and saved: record what from
+        lshindex.write_manifest(index_path, index_manifest)
 
     if args.feature == 'dtw': 
         ## use dtw distances as features
-        ## precompute the distances
-        dtw_distances = dtw_dist_mat(train_dat)
+        ## precompute the distances, or map them from an earlier run
+        dtw_key = filecache.cache_key(args.database, dtw_settings(dtw_band))
+        dtw_cache = dtwmatrix.cache_path(args.database, dtw_key, args.dtw_cache)
+        dtw_distances = dtwmatrix.load(dtw_cache, len(train_dat))
+        if dtw_distances is not None:
+            sys.stderr.write('Using cached DTW distance matrix %s \n' %(dtw_cache))
+        elif args.dtw_lazy:
+            ## only compute the pairs of each query's neighbours, on demand
+            dtw_store = None
+            if args.dtw_persist:
+                dtw_store = dtwmatrix.cache_path(args.database, dtw_key, args.dtw_cache, partial=True)
+            dtw_distances = dtwmatrix.LazyDistanceMatrix(len(train_dat), lambda i, j: dtw_pair(train_dat, i, j, dtw_band),
+                                                         args.dtw_memo, dtw_store)
+        else:
+            dtw_distances = dtw_dist_mat(train_dat, jobs, dtw_band)
+            dtwmatrix.save(dtw_cache, dtw_distances)
+
+    svm_parms = args.svm_parms
+    feature_map = None
+    if args.feature == 'rff':
+        ## map the training set once into the random Fourier features of
+        ## the RBF kernel, or load them from an earlier run; the per-query
+        ## SVMs are linear on them
+        gamma = svm.svm_parameter(parse_svm_parms(args.svm_parms)).gamma or 1.0/len(train_dat[0])
+        feature_map = fourierfeatures.RandomFourierFeatures(len(train_dat[0]), args.rff_components, gamma, args.rff_seed)
+        rff_cache = filecache.cache_path(args.database, 'rff', filecache.cache_key(args.database, feature_map.settings()))
+        features = filecache.load(rff_cache, (len(train_dat), args.rff_components), 'feature cache')
+        if features is not None:
+            sys.stderr.write('Using cached random Fourier features %s \n' %(rff_cache))
+        else:
+            features = feature_map.transform(train_mat)
+            filecache.save(rff_cache, features, 'feature cache')
+        svm_parms = linear_svm_parms(svm_parms)
+    else:
+        features = train_features(train_mat, args.feature)
+
+    ## libsvm nodes of the training features, shared by all queries
+    ## (or their kernel matrix, then the SVMs use it as a precomputed kernel)
+    ## (or the features themselves for the batch solver)
+    if args.svm_solver == 'batch':
+        nodes = features
+    else:
+        nodes = train_nodes(features, svm_parms, args.precompute_kernel)
+    if args.precompute_kernel:
+        svm_parms += ',t:4'
 
     index_time_e = time()
     accuracy  = 0
+    counter = 0
+    correct_prediction = 0
+    unclassified = 0
+    svm_queries = 0
+    svm_trainings = 0
+    ## one-against-one work of all the neighbours' classes, and of those kept
+    binary_svms = [0, 0]
+    kernel_values = [0, 0]
+    global _query_state
+    model_cache = None
+    if args.model_cache > 0 or args.share_overlap > 0:
+        model_cache = modelcache.ModelCache(args.model_cache, getattr(nodes, 'nodes', None))
+    _query_state = (mat, k, train_class_label, nodes, args.feature, svm_parms, dtw_distances, feature_map, args.top_classes, model_cache)
+    ## the workers rely on fork to share the index, and --svm_threads
+    ## and the batch solver classify the queries in this process, as does
+    ## --dtw_persist, which saves the distances computed here
+    query_jobs = jobs if hasattr(os, 'fork') and args.svm_threads <= 0 and args.svm_solver == 'libsvm' else 1
+    if isinstance(dtw_distances, dtwmatrix.LazyDistanceMatrix) and dtw_distances.store_path is not None:
+        query_jobs = 1
     with open(args.query, 'rU') as f:
-        counter = 0
-        correct_prediction = 0
-        for l in f:
-            counter += 1
-            line = l.strip().split(',')
-            if args.isTesting:
-                test_class_label = int(line[0])
-                test_dat = map(float, line[1:])
-            else:
-                test_dat = map(float, line)
-                test_class_label = 1
-                
-            result = mat.query(test_dat, 2, k)
-            kNN_index = result[0]
+        if args.batch:
+            ## read every query, then look up all neighbours in one pass
+            queries = list(read_queries(f, args.isTesting))
+            kNN_indexes = knn_search(mat, [test_dat for test_class_label, test_dat in queries], k)
+            if args.share_overlap > 0:
+                kNN_indexes, groups = share_neighbours(kNN_indexes, train_class_label, args.share_overlap)
+                ## the model cache keeps the SVM of every group
+                model_cache.capacity = max(model_cache.capacity, groups)
+                sys.stderr.write('Sharing SVMs: %d groups of queries \n' %(groups))
+            tasks = [(test_class_label, test_dat, kNN_index)
+                     for (test_class_label, test_dat), kNN_index in itertools.izip(queries, kNN_indexes)]
+        else:
+            tasks = ((test_class_label, test_dat, None) for test_class_label, test_dat in read_queries(f, args.isTesting))
 
-            kNN_labels = [ train_class_label[i] for i in kNN_index]
+        if args.svm_solver == 'batch':
+            results = classify_batches(tasks, QUERY_BATCH)
+        elif args.svm_threads > 0:
+            ## neighbours and SVM problems here, libsvm on the threads
+            pipeline = threadpipe.ThreadPipeline(finish_query, args.svm_threads)
+            results = pipeline.imap(itertools.imap(prepare_query, tasks))
+        elif query_jobs > 1:
+            sys.stderr.write('Classifying queries with %d jobs \n' %(query_jobs))
+            pool = multiprocessing.Pool(query_jobs)
+            ## imap keeps the input order
+            results = pool.imap(classify_query, tasks, QUERY_CHUNK)
+        else:
+            results = itertools.imap(classify_query, tasks)
 
+        for test_class_label, p_label, train_time, test_time, trained, work in results:
+            counter += 1
             sys.stderr.write("Processing test case %d\n" %(counter))
-
-            ## if kNN are all of one class, just report that
-            tmp_label = kNN_labels[0]
-            if all(label == tmp_label for label in kNN_labels):
-                p_label = [tmp_label]
-                sys.stderr.write("All nearest neighbour belong to the same class %d, assign class lazily...\n" %(tmp_label))
-            ## else run the eager learning part
+            if p_label is None:
+                sys.stderr.write("No nearest neighbour found, cannot classify...\n")
+                unclassified += 1
+            elif train_time is None:
+                sys.stderr.write("All nearest neighbour belong to the same class %d, assign class lazily...\n" %(p_label))
             else:
-                train_time_s = time()
-                if args.feature == 'dtw':
-                    ## retrieve dtw feature matrix
-                    kNN_dat = []
-                    for i in kNN_index:
-                        kNN_dat.append([dtw_distances[i][x] for x in kNN_index])
-                elif args.feature == 'dwt':
-                    kNN_dat = [ discreteHaarWaveletTransform(train_dat[i]) for i in kNN_index]
-                else:
-                    kNN_dat = [ train_dat[i] for i in kNN_index ]
-                
-                ## training
-                model = svm.svm_train(kNN_labels, kNN_dat, parse_svm_parms(args.svm_parms))
-                train_time_e = time()
-                total_train_time += train_time_e - train_time_s
-                ## testing
-                test_time_s = time()
-                p_label, p_acc, p_val = svm.svm_predict([test_class_label], [test_dat], model ,'-q')
-                test_time_e = time()
-                total_test_time += test_time_e - test_time_s
+                total_train_time += train_time
+                total_test_time += test_time
+                svm_queries += 1
+                svm_trainings += trained
+            if work is not None and trained:
+                for n, (svms, values) in enumerate(work):
+                    binary_svms[n] += svms
+                    kernel_values[n] += values
             if args.isTesting:
-                if test_class_label == p_label[0]:
+                if test_class_label == p_label:
                     correct_prediction += 1
                     sys.stderr.write('Correct!\n')
                 else:
                     sys.stderr.write('Wrong!\n')
+            elif p_label is None:
+                args.outfile.write("?\n")
             else:
-                args.outfile.write("%d\n" %(p_label[0]))
+                args.outfile.write("%d\n" %(p_label))
 
-        sys.stderr.write('=============================================================\n')
+        if query_jobs > 1:
+            pool.close()
+            pool.join()
+
+    sys.stderr.write('=============================================================\n')
+
+    if args.isTesting:
+        sys.stderr.write("Number of test cases: %d \n" %(counter))
+        sys.stderr.write("Number of correct predictions: %d \n" %(correct_prediction))
+        accuracy = correct_prediction*1.0/counter
+        sys.stderr.write("Accuracy: %.2f \n" %(accuracy)) 
+    if unclassified:
+        sys.stderr.write("Unclassified queries (no nearest neighbour found): %d \n" %(unclassified))
 
-        if args.isTesting:
-            sys.stderr.write("Number of test cases: %d \n" %(counter))
-            sys.stderr.write("Number of correct predictions: %d \n" %(correct_prediction))
-            accuracy = correct_prediction*1.0/counter
-            sys.stderr.write("Accuracy: %.2f \n" %(accuracy)) 
+    if args.svm_threads > 0:
+        sys.stderr.write(pipeline.stats() + ' \n')
+    ## the counters of work done in the query workers are not collected
+    if hasattr(mat, 'stats') and (query_jobs == 1 or args.batch):
+        sys.stderr.write(mat.stats() + ' \n')
+    if isinstance(dtw_distances, dtwmatrix.LazyDistanceMatrix):
+        dtw_distances.flush()
+    if model_cache is not None:
+        sys.stderr.write("SVMs trained: %d for %d queries (%d avoided) \n"
+                         %(svm_trainings, svm_queries, svm_queries - svm_trainings))
+    if model_cache is not None and query_jobs == 1:
+        sys.stderr.write(model_cache.stats() + ' \n')
+    if args.top_classes > 0:
+        sys.stderr.write("Top %d classes: %d binary SVMs trained instead of %d, %d kernel values instead of %d (%.2f%% saved) \n"
+                         %(args.top_classes, binary_svms[1], binary_svms[0], kernel_values[1], kernel_values[0],
+                           100.0 - kernel_values[1]*100.0/max(kernel_values[0], 1)))
+    if isinstance(dtw_distances, dtwmatrix.LazyDistanceMatrix) and query_jobs == 1:
+        total_pairs = dtwmatrix.condensed_size(len(train_dat))
+        sys.stderr.write("DTW distances computed: %d of %d (%.2f%%) \n"
+                         %(dtw_distances.computed, total_pairs, dtw_distances.computed*100.0/max(total_pairs, 1)))
 
     elapsed_time_e = time()
     elapsed_time = elapsed_time_e - elapsed_time_s
@@ -235,8 +814,15 @@ def main(arguments):
         args.outfile.write('IndexTime\t%s\n' %(index_time))
         args.outfile.write('TrainingTime\t%s\n' %(total_train_time))
         args.outfile.write('TestingTime\t%s\n' %(total_test_time))    
+        if model_cache is not None and query_jobs == 1:
+            args.outfile.write('ModelCacheHitRate\t%f\n' %(model_cache.hit_rate()))
+            args.outfile.write('ModelCacheMemory\t%d\n' %(model_cache.memory))
+        if args.top_classes > 0:
+            args.outfile.write('BinarySVMs\t%d\n' %(binary_svms[1]))
+            args.outfile.write('BinarySVMsAllClasses\t%d\n' %(binary_svms[0]))
     
-    os.remove(tmp_index)
+    if os.path.exists(tmp_index):
+        os.remove(tmp_index)
     os.rmdir(tmp_folder)
 
 if __name__ == '__main__':
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""Arrays of the training set cached next to the database
+
+The DTW distance matrix and the random Fourier features of the training
+set are stored as float64 .npy files, <database>.<kind>_<key>.npy, so later
+runs can memory-map them. The key is made of the SHA-1 of the training file
+and a string of the settings the array depends on, so a changed database or
+different settings never hit an old file. Files are written under a
+temporary name and renamed once complete, after their content is checked;
+a marker, <file>.done, then records the size and mtime of the file. Loading
+only checks the header and the marker, not the content.
+"""
+
+import os
+import sys
+import hashlib
+import numpy as np
+from ucrdata import file_digest, save_atomic
+
+
+def cache_key(database, settings):
+    ## settings: a string describing how the array is computed
+    h = hashlib.sha1(file_digest(database))
+    h.update(settings)
+    return h.hexdigest()[:16]
+
+def cache_path(database, kind, key, cache_dir=None, suffix='.npy'):
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(database))
+    return os.path.join(cache_dir, '%s.%s_%s%s' %(os.path.basename(database), kind, key, suffix))
+
+def marker_path(path):
+    return path + '.done'
+
+def stamp(path):
+    ## size and mtime of a written file, recorded in its marker
+    st = os.stat(path)
+    return '%d %r\n' %(st.st_size, st.st_mtime)
+
+def load(path, shape, what):
+    """Memory-map the cached float64 array of the given shape (None for
+    any size along an axis), None if it is missing or unusable (then it is
+    removed). Only the header and the marker are read: the content was
+    checked when it was saved."""
+    if not os.path.exists(path):
+        return None
+    try:
+        array = np.load(path, mmap_mode='r')
+        if array.dtype != np.float64 or len(array.shape) != len(shape) or \
+           any(size is not None and size != found for size, found in zip(shape, array.shape)):
+            raise ValueError('unexpected shape %s' %(array.shape,))
+        if not os.path.exists(marker_path(path)):
+            raise ValueError('no marker of a finished write')
+        with open(marker_path(path)) as f:
+            if f.read() != stamp(path):
+                raise ValueError('changed since it was written')
+    except (IOError, ValueError) as e:
+        sys.stderr.write('Discarding corrupt %s %s (%s)\n' %(what, path, e))
+        array = None
+        remove(path)
+        return None
+    return array
+
+def save(path, array, what, check=None):
+    """Write the array atomically (write + rename), then its marker.
+    check(array) may raise ValueError to keep it out of the cache."""
+    try:
+        if check is not None:
+            check(array)
+        save_atomic(path, np.save, array)
+        save_atomic(marker_path(path), lambda f: f.write(stamp(path)))
+    except (IOError, OSError, ValueError) as e:
+        sys.stderr.write('Cannot write %s %s (%s)\n' %(what, path, e))
+
+def remove(path):
+    for p in (path, marker_path(path)):
+        if os.path.exists(p):
+            os.remove(p)
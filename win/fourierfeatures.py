@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+"""Random Fourier features of the RBF kernel
+
+Rahimi and Recht's map z(x) = sqrt(2/D) cos(Wx + b), with the D columns of
+W drawn from N(0, 2 gamma I) and b uniform in [0, 2 pi), so that z(x).z(y)
+approximates the RBF kernel exp(-gamma |x-y|^2). A linear SVM on z(x) then
+stands in for an RBF SVM on x. The map only depends on the series length,
+gamma, D and the seed, so the mapped training set is cached next to the
+database by filecache, like the DTW distance matrix, under a key of the
+training file and settings().
+"""
+
+import numpy as np
+
+
+class RandomFourierFeatures(object):
+
+    def __init__(self, dim, n_components, gamma, seed=0):
+        self.dim = dim
+        self.n_components = n_components
+        self.gamma = gamma
+        self.seed = seed
+        rs = np.random.RandomState(seed)
+        self.weights = rs.normal(scale=np.sqrt(2.0*gamma), size=(dim, n_components))
+        self.offsets = rs.uniform(0, 2*np.pi, size=n_components)
+        self.scale = np.sqrt(2.0/n_components)
+
+    def settings(self):
+        ## what the map depends on, for the cache key
+        return 'rff;dim=%d;components=%d;gamma=%r;seed=%d' %(self.dim, self.n_components, self.gamma, self.seed)
+
+    def transform(self, x):
+        """The features of the rows of x, or of the single series x."""
+        x = np.asarray(x, dtype=np.float64)
+        return self.scale*np.cos(np.dot(x, self.weights) + self.offsets)
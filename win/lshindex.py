@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""Saved LSH indexes, reused across runs
+
+The LSH indexes (LSHBOX's, or numpylsh's) load the index file passed to
+init_mat when it exists, and build and save it otherwise. An index kept
+for later runs gets a manifest next to it, <index>.manifest, recording
+what it was built from: the SHA-1 of the training file, its shape, the LSH
+method and parameters, and the module that built it. An index is only
+loaded when its manifest matches the current run.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import ucrdata
+
+## LSH parameters only used by queries, which any index of the same
+## database and other parameters serves
+QUERY_PARMS = ('P',)
+
+
+def manifest(database, lsh_method, lsh_parms, library, shape):
+    return {'database_sha1': ucrdata.cached_digest(database),
+            'shape': list(shape),
+            'lsh_method': lsh_method,
+            'lsh_parms': dict((str(p), str(v)) for p, v in lsh_parms.items() if p not in QUERY_PARMS),
+            'library': library}
+
+def cache_path(database, manifest, cache_dir=None):
+    ## the default place of an index: next to the database, under a key of
+    ## everything in its manifest
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(database))
+    key = hashlib.sha1(json.dumps(manifest, sort_keys=True)).hexdigest()[:16]
+    return os.path.join(cache_dir, '%s.%s_%s.lsh' %(os.path.basename(database), manifest['lsh_method'], key))
+
+def manifest_path(index_path):
+    return index_path + '.manifest'
+
+def read_manifest(index_path):
+    """The manifest of the index at index_path, None if it has none."""
+    try:
+        with open(manifest_path(index_path)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def write_manifest(index_path, manifest):
+    """Write the manifest atomically (write + rename), once the index is saved."""
+    path = manifest_path(index_path)
+    try:
+        ## rename cannot replace a file on Windows
+        if os.path.exists(path):
+            os.remove(path)
+        ucrdata.save_atomic(path, lambda f: json.dump(manifest, f, sort_keys=True))
+    except (IOError, OSError) as e:
+        sys.stderr.write('Cannot write LSH index manifest %s (%s)\n' %(path, e))
+
+def remove(index_path):
+    for path in (index_path, manifest_path(index_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def reusable(index_path, manifest):
+    """True if the index at index_path can be loaded, False if there is
+    none; raises ValueError if there is one built for something else."""
+    if not os.path.exists(index_path):
+        return False
+    saved = read_manifest(index_path)
+    if saved is None:
+        raise ValueError('%s has no manifest' %(index_path))
+    different = sorted(key for key in set(saved) | set(manifest) if saved.get(key) != manifest.get(key))
+    if different:
+        raise ValueError('%s was built with a different %s' %(index_path, ', '.join(different)))
+    return True
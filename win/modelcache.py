@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""LRU cache of the per-query SVM models
+
+Queries close to each other often get the same neighbours, and so would
+train the same SVM again. Models are kept under a key naming their
+training set, the least recently used one is dropped when the cache is
+full; the svm_model then frees its libsvm memory when it is collected
+(svm_model.__del__), and its x_space with it unless the nodes are shared.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+def model_size(model, shared_nodes=None):
+    """Approximate bytes held by a trained model: libsvm's arrays, and the
+    node block of its problem unless it is shared_nodes."""
+    l, nr_class = model.l, model.nr_class
+    size = l*(8 + 8*(nr_class-1) + 4)  ## SV pointers, sv_coef, sv_indices
+    size += 8*nr_class*(nr_class-1)//2 + 8*nr_class  ## rho, label and nSV
+    nodes = getattr(model.x_space, 'nodes', None)
+    if nodes is not None and nodes is not shared_nodes:
+        size += nodes.nbytes
+    return size
+
+
+class ModelCache(object):
+    """At most capacity entries of (model, neighbour indices in training
+    order); safe to use from several threads."""
+
+    def __init__(self, capacity, shared_nodes=None):
+        self.capacity = capacity
+        self.shared_nodes = shared_nodes
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.memory = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[key] = entry
+            return entry[:2]
+
+    def put(self, key, model, index):
+        size = model_size(model, self.shared_nodes)
+        with self._lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.memory -= old[2]
+            self.entries[key] = (model, index, size)
+            self.memory += size
+            while len(self.entries) > self.capacity:
+                self.memory -= self.entries.popitem(last=False)[1][2]
+                self.evictions += 1
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits*1.0/lookups if lookups else 0.0
+
+    def stats(self):
+        return ('Model cache: %d hits, %d misses (%.2f%% hit rate), %d evictions, %d models in %d bytes'
+                %(self.hits, self.misses, self.hit_rate()*100, self.evictions, len(self.entries), self.memory))
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+"""
+Batched solver for many small C-SVC problems (linear and RBF kernels)
+
+For problems of a few dozen instances, the fixed costs of a libsvm call
+(converting the data, allocating the kernel cache, building the model)
+dominate the optimisation itself. svm_train_batch instead stacks the
+binary (one-against-one) sub-problems of a whole list of problems into
+padded arrays, as many at a time as BATCH_ELEMENTS allows, and runs SMO,
+the two-coordinate descent of libsvm, on all of them at once: every
+iteration selects a working pair and updates it in each unfinished
+sub-problem with a handful of numpy operations. The working set
+selection, the update and the bias follow libsvm's Solver without
+shrinking, so the models agree with svm_train up to rounding.
+"""
+
+import numpy as np
+from svm import svm_parameter, C_SVC, LINEAR, RBF
+
+__all__ = ['svm_batch_model', 'svm_train_batch', 'svm_predict_batch']
+
+TAU = 1e-12
+## elements of the padded arrays of one solve call (X is (B, n, d), the
+## kernel and Q (B, n, n)), bounding its memory
+BATCH_ELEMENTS = 1 << 22
+
+
+def kernel(kernel_type, gamma, a, b):
+	"""Kernel of the rows of a with the rows of b, both (..., rows, d)."""
+	dot = np.matmul(a, np.swapaxes(b, -1, -2))
+	if kernel_type == LINEAR:
+		return dot
+	sq = (a*a).sum(axis=-1)[..., :, None] + (b*b).sum(axis=-1)[..., None, :] - 2*dot
+	gamma = np.asarray(gamma, dtype=np.float64).reshape(np.shape(gamma) + (1, 1))
+	return np.exp(-gamma*np.maximum(sq, 0))
+
+
+def solve(K, y, valid, C, eps, max_iter=10000000):
+	"""
+	solve(K, y, valid, C, eps [, max_iter]) -> (alpha, rho)
+
+	The C-SVC dual of B binary problems padded to n instances: K and y
+	are (B, n, n) and (B, n), y in {+1, -1}, valid masks the padding.
+	"""
+	B, n = y.shape
+	## libsvm caches Q in single precision, its diagonal in double
+	Q = (y[:, :, None]*y[:, None, :]*K).astype(np.float32)
+	QD = np.einsum('bii->bi', K).astype(np.float64)
+	alpha = np.zeros((B, n))
+	G = np.where(valid, -1.0, 0.0)
+	inf = np.inf
+
+	## the unfinished problems, copied out and compacted as they finish
+	act = np.flatnonzero(valid.any(axis=1))
+	a, g, yy, v, Qa, QDa = alpha[act], G[act], y[act], valid[act], Q[act], QD[act]
+	## bound reached by increasing y*alpha / decreasing it
+	top = np.where(yy > 0, C, 0.0)
+	bottom = np.where(yy > 0, 0.0, C)
+	running = np.ones(len(act), dtype=bool)
+	for iteration in xrange(max_iter):
+		if not running.all():
+			alpha[act], G[act] = a, g
+			if not running.any():
+				break
+			act, a, g, yy, v, Qa, QDa, top, bottom = [z[running] for z in
+				(act, a, g, yy, v, Qa, QDa, top, bottom)]
+			running = running[running]
+		rows = np.arange(len(act))
+
+		## working set selection (WSS 2 of libsvm), ties to the last index
+		yg = yy*g
+		score = np.where(v & (a != top), -yg, -inf)
+		i = n - 1 - np.argmax(score[:, ::-1], axis=1)
+		Gmax = score[rows, i]
+		low = v & (a != bottom)
+		Gmax2 = np.where(low, yg, -inf).max(axis=1)
+		Q_i = Qa[rows, i]
+		y_i = yy[rows, i]
+		grad_diff = Gmax[:, None] + yg
+		quad = QDa[rows, i][:, None] + QDa - 2.0*(y_i[:, None]*yy)*Q_i
+		quad[quad <= 0] = TAU
+		obj = np.where(low & (grad_diff > 0), -(grad_diff*grad_diff)/quad, inf)
+		j = n - 1 - np.argmin(obj[:, ::-1], axis=1)
+		running = (Gmax + Gmax2 >= eps) & np.isfinite(obj[rows, j])
+
+		Q_j = Qa[rows, j]
+		y_j = yy[rows, j]
+		a_i, a_j = a[rows, i], a[rows, j]
+		G_i, G_j = g[rows, i], g[rows, j]
+		Q_ij = Q_i[rows, j].astype(np.float64)
+		QD_i, QD_j = QDa[rows, i], QDa[rows, j]
+
+		## the two-variable update of libsvm, for y_i != y_j and y_i == y_j
+		other = y_i != y_j
+		same = ~other
+		quad = np.where(other, QD_i + QD_j + 2*Q_ij, QD_i + QD_j - 2*Q_ij)
+		quad[quad <= 0] = TAU
+		diff = a_i - a_j
+		total = a_i + a_j
+		delta = np.where(other, -G_i - G_j, G_i - G_j)/quad
+		new_i = np.where(other, a_i + delta, a_i - delta)
+		new_j = a_j + delta
+
+		up = diff > 0
+		over = total > C
+		other_up, other_down = other & up, other & ~up
+		same_over, same_under = same & over, same & ~over
+		for m, value_i, value_j in (
+				(other_up & (new_j < 0), diff, 0),
+				(other_down & (new_i < 0), 0, -diff),
+				(other_up & (new_i > C), C, C - diff),
+				(other_down & (new_j > C), C + diff, C),
+				(same_over & (new_i > C), C, total - C),
+				(same_under & (new_j < 0), total, 0),
+				(same_over & (new_j > C), total - C, C),
+				(same_under & (new_i < 0), 0, total)):
+			if m.any():
+				new_i = np.where(m, value_i, new_i)
+				new_j = np.where(m, value_j, new_j)
+		## finished problems keep their alphas
+		new_i = np.where(running, new_i, a_i)
+		new_j = np.where(running, new_j, a_j)
+
+		a[rows, i] = new_i
+		a[rows, j] = new_j
+		g += Q_i*(new_i - a_i)[:, None] + Q_j*(new_j - a_j)[:, None]
+
+	## bias, as libsvm's calculate_rho
+	yG = y*G
+	upper = valid & (alpha >= C)
+	lower = valid & (alpha <= 0)
+	free = valid & ~upper & ~lower
+	ub = np.where((upper & (y < 0)) | (lower & (y > 0)), yG, inf).min(axis=1)
+	lb = np.where((upper & (y > 0)) | (lower & (y < 0)), yG, -inf).max(axis=1)
+	nr_free = free.sum(axis=1)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		rho = np.where(nr_free > 0, np.where(free, yG, 0).sum(axis=1)/nr_free, (ub + lb)/2)
+	return alpha, rho
+
+
+class svm_batch_model(object):
+	"""
+	A C-SVC model trained by svm_train_batch: for every pair of classes
+	(s, t), in the order of model.label, the support vectors, their
+	coefficients and the bias of the s-against-t decision function.
+	"""
+	def __init__(self, label, kernel_type, gamma):
+		self.label = label
+		self.kernel_type = kernel_type
+		self.gamma = gamma
+		self.pairs = []
+
+	def get_nr_class(self):
+		return len(self.label)
+
+	def get_labels(self):
+		return list(self.label)
+
+	def predict(self, x):
+		"""predict(x) -> (label, decision values), as svm_predict"""
+		x = np.asarray(x, dtype=np.float64)
+		votes = [0]*len(self.label)
+		dec_values = []
+		for s, t, SV, coef, rho in self.pairs:
+			d = max(SV.shape[1], len(x))
+			## absent features are zeros, as in libsvm's sparse vectors
+			sv = np.zeros((len(SV), d))
+			sv[:, :SV.shape[1]] = SV
+			q = np.zeros((1, d))
+			q[0, :len(x)] = x
+			value = float(np.dot(coef, kernel(self.kernel_type, self.gamma, sv, q)[:, 0]) - rho)
+			dec_values.append(value)
+			if value > 0:
+				votes[s] += 1
+			else:
+				votes[t] += 1
+		return self.label[votes.index(max(votes))], dec_values
+
+
+def svm_train_batch(problems, options=None):
+	"""
+	svm_train_batch(problems [, options]) -> [svm_batch_model]
+
+	Train one model for every (y, x) of problems, x a dense 2-D array, as
+	svm_train(y, x, options) would. Only C-SVC (-s 0) with a linear (-t 0)
+	or RBF (-t 2) kernel is supported; -c, -g, -e are used, -m, -h and -q
+	do not apply.
+	"""
+	param = svm_parameter(options)
+	if param.svm_type != C_SVC or param.kernel_type not in (LINEAR, RBF):
+		raise ValueError('Only C-SVC with a linear or RBF kernel can be trained in batch')
+	if param.nr_weight or param.probability or param.cross_validation:
+		raise ValueError('Class weights, probability estimates and cross validation are not supported in batch')
+
+	models = []
+	subproblems = []
+	for y, x in problems:
+		x = np.asarray(x, dtype=np.float64)
+		if len(y) != len(x):
+			raise ValueError("len(y) != len(x)")
+		## classes in order of first appearance, as in libsvm
+		label = []
+		groups = {}
+		for n, yi in enumerate(y):
+			if yi not in groups:
+				label.append(yi)
+				groups[yi] = []
+			groups[yi].append(n)
+		gamma = param.gamma
+		if gamma == 0:
+			## 1/number of features, libsvm's default
+			used = np.flatnonzero((x != 0).any(axis=0))
+			if len(used):
+				gamma = 1.0/(used[-1] + 1)
+		model = svm_batch_model(label, param.kernel_type, gamma)
+		models.append(model)
+		for s in xrange(len(label)):
+			for t in xrange(s+1, len(label)):
+				index = groups[label[s]] + groups[label[t]]
+				subproblems.append((model, s, t, x[index], len(groups[label[s]])))
+
+	for chunk in _chunks(subproblems):
+		_train_subproblems(chunk, param)
+	return models
+
+
+def _chunks(subproblems):
+	"""Consecutive runs of subproblems whose padded arrays, (B, n, d) for X
+	and (B, n, n) for the kernel, hold at most BATCH_ELEMENTS elements."""
+	chunk = []
+	n = d = 0
+	for sub in subproblems:
+		sub_n, sub_d = sub[3].shape
+		new_n, new_d = max(n, sub_n), max(d, sub_d)
+		if chunk and (len(chunk) + 1)*new_n*max(new_n, new_d) > BATCH_ELEMENTS:
+			yield chunk
+			chunk = []
+			new_n, new_d = sub_n, sub_d
+		chunk.append(sub)
+		n, d = new_n, new_d
+	if chunk:
+		yield chunk
+
+
+def _train_subproblems(subproblems, param):
+	## solve the binary subproblems together and add their decision
+	## functions to their models
+	n = max(len(sub[3]) for sub in subproblems)
+	d = max(sub[3].shape[1] for sub in subproblems)
+	X = np.zeros((len(subproblems), n, d))
+	Y = np.zeros((len(subproblems), n))
+	valid = np.zeros((len(subproblems), n), dtype=bool)
+	gammas = np.empty(len(subproblems))
+	for b, (model, s, t, xb, positive) in enumerate(subproblems):
+		X[b, :len(xb), :xb.shape[1]] = xb
+		Y[b, :positive] = 1
+		Y[b, positive:len(xb)] = -1
+		valid[b, :len(xb)] = True
+		gammas[b] = model.gamma
+	alpha, rho = solve(kernel(param.kernel_type, gammas, X, X), Y, valid, param.C, param.eps)
+
+	for b, (model, s, t, xb, positive) in enumerate(subproblems):
+		sv = np.flatnonzero(alpha[b, :len(xb)] > 0)
+		model.pairs.append((s, t, xb[sv], (Y[b]*alpha[b])[sv], rho[b]))
+
+
+def svm_predict_batch(models, x):
+	"""
+	svm_predict_batch(models, x) -> (p_labels, p_vals)
+
+	The label and decision values of x[m] under models[m], for every m.
+	"""
+	p_labels, p_vals = [], []
+	for model, xi in zip(models, x):
+		label, values = model.predict(xi)
+		p_labels.append(label)
+		p_vals.append(values)
+	return p_labels, p_vals
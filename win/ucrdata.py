@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""Loader for time series files in the UCR format
+
+One series per line, comma separated, the class label first. The file is
+parsed in bulk into a label vector and a contiguous float64 matrix, and both
+are cached next to it:
+
+  <file>.npy  the data matrix, memory-mapped by later runs
+  <file>.npz  the labels, and the size, mtime and SHA-1 of <file>
+
+A cache whose size and mtime still match the file is used as is; if only
+the mtime changed the SHA-1 decides (and the new mtime is recorded),
+anything else rebuilds the cache.
+"""
+
+import os
+import sys
+import hashlib
+import numpy as np
+
+
+def file_digest(file_name, block_size=1 << 20):
+    h = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def cached_digest(file_name):
+    """SHA-1 of file_name, taken from the metadata of its cache when that
+    is still valid (same size and mtime) instead of reading the file."""
+    st = os.stat(file_name)
+    try:
+        with np.load(file_name + '.npz') as meta:
+            if int(meta['size']) == st.st_size and float(meta['mtime']) == st.st_mtime:
+                return str(meta['sha1'])
+    except Exception:
+        ## missing or corrupt cache
+        pass
+    return file_digest(file_name)
+
+def save_atomic(path, save, *args, **kwargs):
+    ## save(f, *args, **kwargs) into a temporary file, renamed to path once written
+    tmp_path = '%s.%d.tmp' %(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            save(f, *args, **kwargs)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def parse(file_name, labelled=True):
+    """parse(file_name [, labelled]) -> (labels, dat)
+
+    labels is None if the file has no label column.
+    """
+    with open(file_name, 'rU') as f:
+        text = f.read().strip()
+    if not text:
+        raise ValueError('%s is empty' %(file_name))
+    lines = text.count('\n') + 1
+    values = np.fromstring(text.replace('\n', ','), sep=',')
+    ## fromstring stops at the first field it cannot read
+    if values.size != text.count(',') + lines:
+        raise ValueError('%s: field %d is not a number' %(file_name, values.size + 1))
+    if values.size % lines:
+        raise ValueError('%s: time series of different lengths' %(file_name))
+    dat = values.reshape(lines, -1)
+    if not labelled:
+        return None, dat
+    labels = dat[:, 0].astype(int)
+    if (labels != dat[:, 0]).any():
+        raise ValueError('%s: class labels must be integers' %(file_name))
+    return labels, np.ascontiguousarray(dat[:, 1:])
+
+def load(file_name, labelled=True, cache=True):
+    """load(file_name [, labelled, cache]) -> (labels, dat)
+
+    Same as parse, but goes through the .npy/.npz cache next to the file.
+    """
+    if not cache:
+        return parse(file_name, labelled)
+    dat_path, meta_path = file_name + '.npy', file_name + '.npz'
+    st = os.stat(file_name)
+    try:
+        with np.load(meta_path) as meta:
+            meta = dict(meta)
+        if bool(meta['labelled']) != labelled or int(meta['size']) != st.st_size:
+            raise ValueError('stale')
+        touched = float(meta['mtime']) != st.st_mtime
+        if touched and str(meta['sha1']) != file_digest(file_name):
+            raise ValueError('stale')
+        dat = np.load(dat_path, mmap_mode='r')
+        if dat.shape != tuple(meta['shape']) or dat.dtype != np.float64:
+            raise ValueError('corrupt')
+        if touched:
+            ## same content: record the new mtime, so that later runs (and
+            ## cached_digest) need not hash the file again
+            meta['mtime'] = st.st_mtime
+            try:
+                save_meta(meta_path, meta)
+            except (IOError, OSError) as e:
+                sys.stderr.write('Cannot cache %s (%s)\n' %(file_name, e))
+        return (meta['labels'] if labelled else None), dat
+    except Exception:
+        ## missing, stale or corrupt
+        dat = None
+
+    labels, dat = parse(file_name, labelled)
+    try:
+        ## rename cannot replace a file on Windows: remove the old cache,
+        ## the metadata first as it validates the data file
+        for path in (meta_path, dat_path):
+            if os.path.exists(path):
+                os.remove(path)
+        save_atomic(dat_path, np.save, dat)
+        save_meta(meta_path, dict(labels=labels if labelled else np.zeros(0, dtype=int),
+                                  labelled=labelled, size=st.st_size, mtime=st.st_mtime,
+                                  sha1=file_digest(file_name), shape=dat.shape))
+    except (IOError, OSError) as e:
+        sys.stderr.write('Cannot cache %s (%s)\n' %(file_name, e))
+    return labels, dat
+
+def save_meta(meta_path, meta):
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    save_atomic(meta_path, np.savez, **meta)